@@ -0,0 +1,60 @@
+import json
+import time
+
+import Bio.Align as ba
+
+import UtilitiesVariables as uv
+import UtilitiesFunction as uf
+
+import RelativeSequenceGenerator as rsg
+
+def benchmark_individual(reference_sequence, individual_sequence, aligner):
+    """Time both alignment modes on one individual and check that they give the same variants"""
+    start = time.time()
+    global_variants = rsg.cleanup_variants(rsg.compare_subsequences(reference_sequence, individual_sequence, aligner), reference_sequence)
+    global_time = time.time() - start
+
+    start = time.time()
+    anchored_variants = rsg.cleanup_variants(rsg.compare_subsequences_anchored(reference_sequence, individual_sequence, aligner), reference_sequence)
+    anchored_time = time.time() - start
+
+    return global_time, anchored_time, global_variants == anchored_variants, len(global_variants)
+
+
+def benchmark_alignment_modes():
+    """Compare the global and anchored alignment modes on every fasta individual"""
+    with open(uv.INDIVIDUALS_INFORMATION_PATH, "r") as file:
+        individuals_information = json.load(file)
+    with open(uv.REFERENCE_SEQUENCE_INFORMATION_PATH, "r") as file:
+        reference_sequence_information = json.load(file)
+
+    aligner = ba.PairwiseAligner()
+    total_global_time = 0
+    total_anchored_time = 0
+    mismatches = []
+
+    for individual_ID, individual_information in individuals_information.items():
+        reference_sequence_name = individual_information[0]
+        file_path = individual_information[1]
+
+        # Note: Cohort individuals (vcf or multi-fasta) also hold their sample name, they have no fasta of their own to align
+        if len(individual_information) > 2 or ".fasta" not in file_path:
+            continue
+
+        reference_sequence = uf.load_fasta(f"{uv.SEQUENCE_FOLDER}{reference_sequence_information[reference_sequence_name][uv.PATH]}")
+        individual_sequence = uf.load_fasta(f"{uv.INDIVIDUALS_FOLDER}{file_path}")
+        global_time, anchored_time, identical, variant_count = benchmark_individual(reference_sequence, individual_sequence, aligner)
+
+        total_global_time += global_time
+        total_anchored_time += anchored_time
+        if not identical:
+            mismatches.append(individual_ID)
+        print(f"{individual_ID}: {variant_count} variants, {uv.GLOBAL_ALIGNMENT} {global_time:.3f}s, {uv.ANCHORED_ALIGNMENT} {anchored_time:.3f}s, identical variants: {identical}")
+
+    print(f"Total: {uv.GLOBAL_ALIGNMENT} {total_global_time:.3f}s, {uv.ANCHORED_ALIGNMENT} {total_anchored_time:.3f}s")
+    print(f"Individuals with different variants: {mismatches}")
+
+
+if __name__ == "__main__":
+
+    benchmark_alignment_modes()
@@ -0,0 +1,118 @@
+import sys
+import time
+import sqlite3
+
+import UtilitiesVariables as uv
+import UtilitiesFunction as uf
+import Configuration as cf
+
+def open_manifest():
+    """Opening (and creating if needed) the completion manifest, None if the manifest is not used"""
+    if not cf.COMPLETION_MANIFEST:
+        return None
+
+    connection = sqlite3.connect(uv.COMPLETION_MANIFEST_PATH, timeout=60)
+    # Write ahead logging permits all processes to record their centers at the same time
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    
+    # Note: Manifests written before the storage backend was recorded can not be trusted for either backend, they are started again
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(completed_centers)")]
+    if len(columns) > 0 and "backend" not in columns:
+        connection.execute("DROP TABLE completed_centers")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS completed_centers (process_number INTEGER NOT NULL, backend TEXT NOT NULL, sequence_ID TEXT NOT NULL, construct_generation_specification_ID TEXT NOT NULL, center_ID TEXT NOT NULL, completed REAL NOT NULL, PRIMARY KEY (process_number, backend, center_ID)) WITHOUT ROWID"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS completed_centers_sequence ON completed_centers (process_number, backend, sequence_ID, construct_generation_specification_ID)")
+    connection.commit()
+
+    # Completed centers are loaded once per process, sequence and CGS
+    completed_centers = {}
+
+    return connection, completed_centers
+
+
+def storage_backend():
+    """Name of the storage holding the outputs of the centers, centers completed in one storage are not completed in the other"""
+    if cf.RESULT_STORE:
+        return uv.RESULT_STORE_BACKEND
+    return uv.FILE_BACKEND
+
+
+def manifest_key(process_number, center_ID):
+    """Key under which the completed centers of a process, storage backend, sequence and CGS are loaded"""
+    return (process_number, storage_backend(), uf.sequence_ID_from_ID(center_ID), uf.construct_generation_specification_from_ID(center_ID))
+
+
+def center_completed(manifest, process_number, center_ID, file_path):
+    """Check if the output of a center was committed by a process and still exists, without the manifest only the output is checked"""
+    if manifest is None:
+        return uf.output_file_exists(file_path)
+
+    connection, completed_centers = manifest
+    key = manifest_key(process_number, center_ID)
+    if key not in completed_centers:
+        rows = connection.execute(
+            "SELECT center_ID FROM completed_centers WHERE process_number = ? AND backend = ? AND sequence_ID = ? AND construct_generation_specification_ID = ?", key
+        )
+        completed_centers[key] = set(row[0] for row in rows)
+
+    if center_ID not in completed_centers[key]:
+        return False
+    
+    # Outputs can be deleted between executions, the entry of a missing output is removed and the center is calculated again
+    if not uf.output_file_exists(file_path):
+        with connection:
+            connection.execute("DELETE FROM completed_centers WHERE process_number = ? AND backend = ? AND center_ID = ?", (process_number, key[1], center_ID))
+        completed_centers[key].discard(center_ID)
+        return False
+
+    return True
+
+
+def record_completed_center(manifest, process_number, center_ID):
+    """Recording a center once its output file is committed"""
+    if manifest is None:
+        return
+
+    # Note: A center whose file was committed but that was not recorded (interrupted execution) is simply calculated again
+    connection, completed_centers = manifest
+    key = manifest_key(process_number, center_ID)
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO completed_centers VALUES (?, ?, ?, ?, ?, ?)", (*key, center_ID, time.time()))
+    if key in completed_centers:
+        completed_centers[key].add(center_ID)
+
+
+def close_manifest(manifest):
+    """Closing connection to the manifest"""
+    if manifest is not None:
+        manifest[0].close()
+
+
+def completion_summary(manifest, reference_sequence_ID, construct_generation_specification_ID):
+    """Number of completed centers per process for a reference sequence (and its relative sequences) and a CGS, in the storage backend in use"""
+    connection, _ = manifest
+    rows = connection.execute(
+        "SELECT process_number, COUNT(*) FROM completed_centers WHERE backend = ? AND (sequence_ID = ? OR sequence_ID LIKE ?) AND construct_generation_specification_ID = ? GROUP BY process_number",
+        (storage_backend(), reference_sequence_ID, f"{reference_sequence_ID}-%", construct_generation_specification_ID)
+    )
+    return dict(rows.fetchall())
+
+
+if __name__ == "__main__":
+
+    # Usage: python CompletionManifest.py [execution ID], shows how many centers each process already completed for the execution
+    instructions = uf.load_instructions_base(sys.argv[1])
+    reference_sequence_ID = uf.form_reference_sequence_ID(instructions[uv.REFERENCE_SEQUENCE_KEY][0], instructions[uv.REFERENCE_SEQUENCE_KEY][1])
+    construct_generation_specification_ID = uf.form_construct_generation_specification_ID(instructions[uv.CONSTRUCT_GENSPECS_KEY])
+
+    manifest = open_manifest()
+    if manifest is None:
+        raise Exception("Error, In: Completion manifest, the manifest is disabled in Configuration.py")
+    summary = completion_summary(manifest, reference_sequence_ID, construct_generation_specification_ID)
+    close_manifest(manifest)
+
+    # Note: Process 3 creates relative sequences, not centers, it is not recorded in the manifest
+    for process_number in [1, 2, 4, 5, 6]:
+        print(f"{uv.PROCESSES[process_number][0]}: {summary.get(process_number, 0)} completed centers")
@@ -2,4 +2,23 @@ SETTINGS_FILE_PATH = "settings.json"
 PYTHON_VERSION = "python"
 NCPUS = 6
 NCPUS_FOR_ENERGY_CALCULATIONS = 4
-WAITING_TIME = 10
\ No newline at end of file
+ENERGY_CALCULATION_CPU_SHARE = {2: 0.5, 5: 0.5}
+PROCESS_REPLICAS = {2: 1, 5: 1}
+ENERGY_BATCH_MAXIMAL_CONSTRUCTS = 100000
+NCPUS_FOR_RELATIVE_SEQUENCE_GENERATION = 2
+ALIGNMENT_MODE = "Anchored"
+ANCHOR_KMER_SIZE = 24
+WAITING_TIME = 10
+COMPLETION_MANIFEST = True
+FILE_WRITE_BUFFER_SIZE = 4194304
+VIRTUAL_CONSTRUCT_FILES = True
+COST_AWARE_CENTER_SCHEDULING = True
+VARIANT_DRIVEN_RELATIVE_CONSTRUCTS = True
+FACTORIZED_ENERGY_CALCULATION = True
+DUPLEX_ENERGY_CACHE = True
+DUPLEX_ENERGY_CACHE_MAXIMAL_SIZE = 50000000
+REFERENCE_ENERGY_CACHE_MAXIMAL_BYTES = 1073741824
+SPARSE_FRAGILITY_FILES = True
+RESULT_STORE = False
+PERSIST_CONSTRUCT_FILES = False
+REFERENCE_SEQUENCE_STORE = True
\ No newline at end of file
@@ -1,7 +1,7 @@
-import os
 import time
 import logging
 import multiprocessing as mp
+import multiprocessing.connection
 
 import UtilitiesVariables as uv
 import UtilitiesFunction as uf
@@ -11,15 +11,15 @@ PROCESS_NUMBER = 0
 
 def prepare_logs(execution_ID):
     """Preparing human readable and machine readable logs."""
-    log_file_paths = f"{uv.EXECUTION_FOLDER}{execution_ID}{os.sep}{execution_ID}-process_log"
+    log_file_paths = uf.process_log_path(execution_ID)
 
     # Text log, human readable log
     text_logger = logging.getLogger(__name__)
     text_log_path = log_file_paths + ".txt"
     logging.basicConfig(filename=text_log_path, encoding='utf-8', level=logging.DEBUG)
 
-    # Json log, machine readable log
-    json_log_path = log_file_paths + ".json"
+    # Json lines event log, machine readable log, compacted to the process log format at the end of the execution
+    json_log_path = log_file_paths + ".jsonl"
     uf.create_json_log(json_log_path)
 
     def json_logger(category, key, value):
@@ -29,7 +29,7 @@ def prepare_logs(execution_ID):
 
 
 def prepare_queues():
-    """Preparing multiprossesing queues for processing feedback to the controller."""
+    """Preparing multiprossesing queues for processing feedback to the controller, return connections are added when the processes are started."""
     queues = {
         uv.TASK :{
             1: mp.Queue(),
@@ -40,12 +40,12 @@ def prepare_queues():
             6: mp.Queue(),
         },
         uv.RETURN :{
-            1: mp.Queue(),
-            2: mp.Queue(),
-            3: mp.Queue(),
-            4: mp.Queue(),
-            5: mp.Queue(),
-            6: mp.Queue(),
+            1: [],
+            2: [],
+            3: [],
+            4: [],
+            5: [],
+            6: [],
         },
         uv.ERRORS: mp.Queue()
     }
@@ -97,43 +97,76 @@ def check_process_start_condition(process_number, signal_lights):
     return process_can_be_started
 
 
+def process_replicas(process_number):
+    """Number of replicas of a process, replicas share the task and error queues of the process and each return their results through their own pipe."""
+    return cf.PROCESS_REPLICAS.get(process_number, 1)
+
+
+def check_process_replicas():
+    """Check that only processes with independent tasks are replicated."""
+    for process_number, replicas in cf.PROCESS_REPLICAS.items():
+        if replicas > 1 and process_number not in uv.REPLICABLE_PROCESSES:
+            raise Exception(f"Error, In: Configuration, process {process_number} can not be replicated, only processes {uv.REPLICABLE_PROCESSES} can")
+
+
 def initialise_process(instructions, process_number, queues):
-    """Initialising processes with adequate inputs."""
+    """Initialising processes replicas with adequate inputs."""
     module = __import__(uv.PROCESSES[process_number][1])
-    process = mp.Process(target=module.run_process, args=(instructions, queues[uv.TASK][process_number], queues[uv.RETURN][process_number], queues[uv.ERRORS]))
-    process.start()
+    processes = []
+    for _ in range(process_replicas(process_number)):
+        # Each replica returns its results through its own pipe, the controller can wait on the receiving end of the pipes
+        return_connection_receiver, return_connection = mp.Pipe(duplex=False)
+        process = mp.Process(target=module.run_process, args=(instructions, queues[uv.TASK][process_number], return_connection, queues[uv.ERRORS]))
+        process.start()
+        return_connection.close()
+        queues[uv.RETURN][process_number].append(return_connection_receiver)
+        processes.append(process)
         
-    return process
+    return processes
+
+
+def put_task(queues, process_number, task):
+    """Adding a task to the queue of a process, each replica of the process receives its own done signal."""
+    if task[1] == uv.DONE:
+        for _ in range(process_replicas(process_number)):
+            queues[uv.TASK][process_number].put(task)
+    else:
+        queues[uv.TASK][process_number].put(task)
 
 
-def transmit_results(process_number, new_process_results, queues):
+def transmit_results(process_number, new_process_results, process_done, queues):
     "Trasmit results of processes to the corresponding processes that continue the treatment of the data."
+    # Note: A process is done once all its replicas are, the done signal is then transmitted only once
+    new_process_results = [result for result in new_process_results if result[1] != uv.DONE]
+    if process_done:
+        new_process_results.append((process_number, uv.DONE))
+
     if process_number == 1:
         for result in new_process_results:
             # Adding results from reference sequence construct generation to reference sequence energies calculation 
-            queues[uv.TASK][2].put(result) 
+            put_task(queues, 2, result) 
             # Adding results from reference sequence construct generation to relative construct generation
-            queues[uv.TASK][4].put(result)
+            put_task(queues, 4, result)
     
     elif process_number == 2:
         for result in new_process_results:
             # Adding results from reference sequence energies calculation to fragility scoring
-            queues[uv.TASK][6].put(result) 
+            put_task(queues, 6, result) 
     
     elif process_number == 3:
         for result in new_process_results:
             # Adding results from relative sequence generation to relative sequence construct generation
-            queues[uv.TASK][4].put(result) 
+            put_task(queues, 4, result) 
     
     elif process_number == 4:
         for result in new_process_results:
             # Adding results from relative sequence construct generation to relative sequence energies calculation
-            queues[uv.TASK][5].put(result) 
+            put_task(queues, 5, result) 
     
     elif process_number == 5:
         for result in new_process_results:
             # Adding results from relative sequence energies calculation to fragility scoring
-            queues[uv.TASK][6].put(result) 
+            put_task(queues, 6, result) 
 
 
 def update_signal_light(process_number, process_results):
@@ -146,6 +179,19 @@ def update_signal_light(process_number, process_results):
     return turn_on
 
 
+def receive_results(return_connections):
+    """Collecting all results sent by the replicas of a process"""
+    new_process_results = []
+    for return_connection in return_connections:
+        # Note: The pipe of an exited replica is readable once its results are received, receiving from it raises EOFError
+        try:
+            while return_connection.poll():
+                new_process_results.append(return_connection.recv())
+        except EOFError:
+            pass
+    return new_process_results
+
+
 def control_processes(signal_lights, queues, running_processes, results, loop_number, json_logger, text_logger):
     """Collecting results of process transmiting them, saving the results and handling signal lights."""
     for process_number, running_process in running_processes.items():
@@ -153,24 +199,27 @@ def control_processes(signal_lights, queues, running_processes, results, loop_nu
             continue
         
         # Collecting new results of the process
-        new_process_results = []
-        while not queues[uv.RETURN][process_number].empty():
-            new_process_results.append(queues[uv.RETURN][process_number].get())
+        new_process_results = receive_results(queues[uv.RETURN][process_number])
         
+        # Saving results, constructs carried by a result are only transmitted
+        results[process_number].extend(result[:2] for result in new_process_results)
+        process_done = (process_number, uv.DONE) in new_process_results and results[process_number].count((process_number, uv.DONE)) == len(running_process)
+
         # Transmitting new results to processes that is next in line to treat the data.
-        transmit_results(process_number, new_process_results, queues)
-        
-        # Saving results
-        results[process_number].extend(new_process_results)
+        transmit_results(process_number, new_process_results, process_done, queues)
 
-        # Logging results
-        json_logger(uv.LOOP_YIELD_KEY, f"{loop_number}-{process_number}", len(new_process_results))
-        text_logger.info(f"{uv.LOOP_YIELD_KEY}, (loop {loop_number}, process number {process_number}) : {len(new_process_results)}")
+        # Logging results, loops are triggered by events so only loops where the process returned something are logged
+        if len(new_process_results) > 0:
+            json_logger(uv.LOOP_YIELD_KEY, f"{loop_number}-{process_number}", len(new_process_results))
+            text_logger.info(f"{uv.LOOP_YIELD_KEY}, (loop {loop_number}, process number {process_number}) : {len(new_process_results)}")
         
         # If finished Logging approximate process finish time and deleting reference to process.
-        if (process_number, uv.DONE) in new_process_results:
+        if process_done:
+            json_logger(uv.PROCESS_COUNTERS_KEY, uv.PROCESSES[process_number][0], len(results[process_number]) - len(running_process))
             log_event_time(json_logger, text_logger, uv.TIMEPOINTS_KEY, uv.FINISH_PROCESS_KEY[process_number], uv.FINISH_PROCESS_KEY[process_number])
             running_processes[process_number] = None
+            for return_connection in queues[uv.RETURN][process_number]:
+                return_connection.close()
 
 
         # Handling signal lights
@@ -178,6 +227,36 @@ def control_processes(signal_lights, queues, running_processes, results, loop_nu
             signal_lights[process_number] = update_signal_light(process_number, results[process_number])
 
 
+def wait_for_events(queues, running_processes):
+    """Blocks until a running process returns results or exits, or at most the waiting time."""
+    # Note: Replicas report errors just before exiting, their sentinel is ready once they exited
+    awaitables = []
+    for process_number, running_process in running_processes.items():
+        if running_process is not None:
+            for replica, return_connection in zip(running_process, queues[uv.RETURN][process_number]):
+                if replica.exitcode is None:
+                    awaitables.extend([return_connection, replica.sentinel])
+    
+    mp.connection.wait(awaitables, timeout=cf.WAITING_TIME)
+
+
+def count_exited_replicas(running_processes):
+    """Number of exited replicas of each running process"""
+    return {
+        process_number: sum(replica.exitcode is not None for replica in running_process)
+        for process_number, running_process in running_processes.items() if running_process is not None
+    }
+
+
+def find_exited_process(exited_replicas, running_processes, results):
+    """Finds a process with a replica that exited without announcing it was done"""
+    # Note: Replicas send their results before exiting, results of replicas that exited before the last results were collected are all received
+    for process_number, exited_replica_count in exited_replicas.items():
+        if running_processes[process_number] is not None and exited_replica_count > results[process_number].count((process_number, uv.DONE)):
+            return process_number
+    return None
+
+
 def log_event_time(json_logger, text_logger, json_category, json_key, event_name):
     "Standard human readable and machine readable information logging"
     info_time = time.time()
@@ -198,7 +277,8 @@ def close_processes(processes):
     """Manually terminating processes"""
     for process_number, process in processes.items():
         if not process is None:
-            process.terminate()
+            for replica in process:
+                replica.terminate()
             processes[process_number] = None
 
 
@@ -212,6 +292,7 @@ def launch(execution_ID):
     running_processes = prepare_running_processess()
     results = prepare_results()
 
+    check_process_replicas()
     processes_to_start = instructions[uv.PIPELINE_PROCESS_TO_RUN_KEY]
     running = True
 
@@ -239,8 +320,8 @@ def launch(execution_ID):
         
         processes_to_start = processes_left_to_start
 
-        # Give launched processes time to work
-        time.sleep(cf.WAITING_TIME)
+        # Waiting for launched processes to return something
+        wait_for_events(queues, running_processes)
         
         # Check for errors
         if not queues[uv.ERRORS].empty():
@@ -256,11 +337,26 @@ def launch(execution_ID):
             break
         
         # Update on advancements in processes
+        exited_replicas = count_exited_replicas(running_processes)
         control_processes(signal_lights, queues, running_processes, results, loop_number, json_logger, text_logger)
 
+        # A process that exited without being done nor reporting an error was killed, the pipeline can not finish
+        exited_process_number = find_exited_process(exited_replicas, running_processes, results)
+        if exited_process_number is not None and queues[uv.ERRORS].empty():
+            exit_codes = [replica.exitcode for replica in running_processes[exited_process_number]]
+            text_logger.error(f"Process {exited_process_number} exited with codes {exit_codes} before being done")
+            close_processes(running_processes)
+            running = False
+            log_event_time(json_logger, text_logger, uv.TIMEPOINTS_KEY, uv.END_APP_KEY,  f"{uv.END_APP_KEY} with error")
+
+            break
+
         # Check if application finished
         if signal_lights[6]:
             running = False
 
             # Log end of application
-            log_event_time(json_logger, text_logger, uv.TIMEPOINTS_KEY, uv.END_APP_KEY,  f"{uv.END_APP_KEY} sucessfully")
\ No newline at end of file
+            log_event_time(json_logger, text_logger, uv.TIMEPOINTS_KEY, uv.END_APP_KEY,  f"{uv.END_APP_KEY} sucessfully")
+
+    # Writing the process log from the events of the execution
+    uf.compact_log(execution_ID)
\ No newline at end of file
@@ -0,0 +1,117 @@
+import os
+import time
+import hashlib
+import sqlite3
+import tempfile
+
+import RNA
+
+import UtilitiesVariables as uv
+import Configuration as cf
+
+LOOKUP_BATCH_SIZE = 500
+
+# Computed once per process by energy_model_signature
+ENERGY_MODEL_SIGNATURE = None
+
+def energy_model_signature():
+    """Signature of the ViennaRNA version, energy parameters and model settings used to fold window pairs"""
+    global ENERGY_MODEL_SIGNATURE
+    if ENERGY_MODEL_SIGNATURE is None:
+        # Note: The loaded energy parameters can only be read back by saving them to a file
+        with tempfile.TemporaryDirectory() as folder_path:
+            parameter_file_path = os.path.join(folder_path, "energy_parameters")
+            RNA.params_save(parameter_file_path)
+            with open(parameter_file_path, "rb") as file:
+                parameters = file.read()
+        model_details = RNA.md()
+        model = f"{RNA.__version__}|{model_details.temperature}|{model_details.dangles}|{model_details.noLP}|{model_details.noGU}|{model_details.special_hp}"
+        ENERGY_MODEL_SIGNATURE = hashlib.blake2b(model.encode() + parameters, digest_size=16).hexdigest()
+    return ENERGY_MODEL_SIGNATURE
+
+
+def window_pair_key(window_pair):
+    """Content address of a window pair, identical windows folded with the same energy model always give the same key"""
+    # Note: Energies folded by another ViennaRNA version or energy parameters have other keys, they are never served and are evicted over time
+    return hashlib.blake2b(f"{energy_model_signature()}|{window_pair[0]}|{window_pair[1]}".encode(), digest_size=16).digest()
+
+
+def open_energy_cache():
+    """Opening (and creating if needed) the persistent duplex energy cache"""
+    connection = sqlite3.connect(uv.DUPLEX_ENERGY_CACHE_PATH, timeout=60)
+    # Write ahead logging permits processes 2 and 5 to use the cache at the same time
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS duplex_energies (window_pair_key BLOB PRIMARY KEY, energy REAL NOT NULL, last_used REAL NOT NULL) WITHOUT ROWID"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS duplex_energies_last_used ON duplex_energies (last_used)")
+    connection.commit()
+
+    cache_size = connection.execute("SELECT COUNT(*) FROM duplex_energies").fetchone()[0]
+    cache_statistics = {uv.CACHE_HITS_KEY: 0, uv.CACHE_MISSES_KEY: 0, uv.CACHE_SIZE_KEY: cache_size}
+
+    return connection, cache_statistics
+
+
+def get_cached_energies(energy_cache, window_pairs):
+    """Returns the energies of the window pairs that are already in the cache"""
+    connection, cache_statistics = energy_cache
+    keys = {window_pair_key(window_pair): window_pair for window_pair in window_pairs}
+    key_list = list(keys)
+    cached_energies = {}
+
+    for i in range(0, len(key_list), LOOKUP_BATCH_SIZE):
+        batch = key_list[i : i + LOOKUP_BATCH_SIZE]
+        placeholders = ",".join("?" * len(batch))
+        rows = connection.execute(f"SELECT window_pair_key, energy FROM duplex_energies WHERE window_pair_key IN ({placeholders})", batch)
+        for key, energy in rows:
+            cached_energies[keys[key]] = energy
+
+    # Refreshing usage of hits so that they are the last to be evicted
+    now = time.time()
+    connection.executemany(
+        "UPDATE duplex_energies SET last_used = ? WHERE window_pair_key = ?",
+        [(now, window_pair_key(window_pair)) for window_pair in cached_energies]
+    )
+    connection.commit()
+
+    cache_statistics[uv.CACHE_HITS_KEY] += len(cached_energies)
+    cache_statistics[uv.CACHE_MISSES_KEY] += len(keys) - len(cached_energies)
+
+    return cached_energies
+
+
+def store_energies(energy_cache, window_pair_energies):
+    """Adds newly folded window pairs to the cache and evicts least recently used entries if the cache is full"""
+    connection, cache_statistics = energy_cache
+    now = time.time()
+    connection.executemany(
+        "INSERT OR REPLACE INTO duplex_energies (window_pair_key, energy, last_used) VALUES (?, ?, ?)",
+        [(window_pair_key(window_pair), energy, now) for window_pair, energy in window_pair_energies.items()]
+    )
+    # Note: The size is an estimate, another process may have stored the same window pairs in the meantime
+    cache_statistics[uv.CACHE_SIZE_KEY] += len(window_pair_energies)
+
+    if cache_statistics[uv.CACHE_SIZE_KEY] > cf.DUPLEX_ENERGY_CACHE_MAXIMAL_SIZE:
+        connection.execute(
+            "DELETE FROM duplex_energies WHERE window_pair_key IN (SELECT window_pair_key FROM duplex_energies ORDER BY last_used LIMIT ?)",
+            (cache_statistics[uv.CACHE_SIZE_KEY] - cf.DUPLEX_ENERGY_CACHE_MAXIMAL_SIZE,)
+        )
+        cache_statistics[uv.CACHE_SIZE_KEY] = connection.execute("SELECT COUNT(*) FROM duplex_energies").fetchone()[0]
+    connection.commit()
+
+
+def hit_rate(energy_cache):
+    """Proportion of window pairs found in the cache"""
+    _, cache_statistics = energy_cache
+    lookups = cache_statistics[uv.CACHE_HITS_KEY] + cache_statistics[uv.CACHE_MISSES_KEY]
+    if lookups == 0:
+        return 0
+    return cache_statistics[uv.CACHE_HITS_KEY] / lookups
+
+
+def close_energy_cache(energy_cache):
+    """Closing connection to the cache"""
+    connection, _ = energy_cache
+    connection.close()
@@ -0,0 +1,51 @@
+import sys
+
+import UtilitiesVariables as uv
+import UtilitiesFunction as uf
+
+def record_name_from_header(header):
+    """Name of a fasta record, the first word of its header"""
+    header_words = header[1:].split(maxsplit=1)
+    return header_words[0] if len(header_words) > 0 else ""
+
+
+def fasta_records(fasta_path):
+    """Streams the records of a multi-record fasta file, one (record name, sequence) at a time"""
+    with uf.open_text_file(fasta_path) as fasta_file:
+        record_name = None
+        sequence_lines = []
+        for line in fasta_file:
+            line = line.rstrip("\n")
+            if line.startswith(">"):
+                if record_name is not None:
+                    yield record_name, ''.join(sequence_lines)
+                record_name = record_name_from_header(line)
+                sequence_lines = []
+            elif record_name is not None:
+                sequence_lines.append(line)
+
+        if record_name is not None:
+            yield record_name, ''.join(sequence_lines)
+
+
+def fasta_record_names(fasta_path):
+    """Names of all records of a multi-record fasta file"""
+    record_names = []
+    with uf.open_text_file(fasta_path) as fasta_file:
+        for line in fasta_file:
+            if line.startswith(">"):
+                record_names.append(record_name_from_header(line.rstrip("\n")))
+    return record_names
+
+
+def register_fasta_cohort(fasta_file_name, reference_sequence_name, group_name):
+    """Adds every record of a multi-record fasta file of the individuals folder to the individuals information and to a group of the group file"""
+    record_names = fasta_record_names(f"{uv.INDIVIDUALS_FOLDER}{fasta_file_name}")
+    return uf.register_individuals(fasta_file_name, record_names, reference_sequence_name, group_name)
+
+
+if __name__ == "__main__":
+
+    # Usage: python FastaCohortReader.py [fasta file in the individuals folder] [reference sequence name] [group name]
+    individuals = register_fasta_cohort(sys.argv[1], sys.argv[2], sys.argv[3])
+    print(f"{len(individuals)} individuals added to group {sys.argv[3]}")
@@ -0,0 +1,27 @@
+import sys
+
+import UtilitiesVariables as uv
+import UtilitiesFunction as uf
+
+def summarize_process_log(log):
+    """Human readable summary of the durations of the processes of an execution"""
+    timepoints = log[uv.TIMEPOINTS_KEY]
+    lines = []
+    for process_number in range(1, len(uv.PROCESSES)):
+        start = timepoints.get(uv.START_PROCESS_KEY[process_number])
+        finish = timepoints.get(uv.FINISH_PROCESS_KEY[process_number])
+        if start is None:
+            continue
+        duration = f"{finish - start:.1f}s" if finish is not None else "not finished"
+        results = log[uv.PROCESS_COUNTERS_KEY].get(uv.PROCESSES[process_number][0], "-")
+        lines.append(f"{uv.PROCESSES[process_number][0]}: {duration}, results: {results}")
+    lines.append(f"Errors: {len(log[uv.ERROR_KEY])}")
+    
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    # Usage: python ProcessLogCompactor.py [execution ID], (re)writes the process log (json) of an execution, even while it is running
+    log = uf.compact_log(sys.argv[1])
+    print(summarize_process_log(log))
@@ -2,29 +2,58 @@ import os
 import sys
 import traceback
 
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
 import UtilitiesVariables as uv
 import UtilitiesFunction as uf
+import Configuration as cf
+import CompletionManifest as cm
+import ReferenceSequenceStore as rss
 
 PROCESS_NUMBER = 1
+SEPARATOR_ARRAY = np.frombuffer(b"NNN", dtype=np.uint8)
+
+def sequence_to_array(sequence):
+    """Byte array view of a sequence, permits slicing many arms at once"""
+    return np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)
+
+
+def byte_rows_to_strings(byte_rows):
+    """Converting each row of a byte matrix to a string, decoding all rows at once"""
+    row_size = byte_rows.shape[1]
+    rows = np.ascontiguousarray(byte_rows).tobytes().decode("ascii")
+    return [rows[i : i + row_size] for i in range(0, len(rows), row_size)]
+
 
-def create_windows(arm_starts, sequence, complementary_sequence, arm_size):
-    """Creating standard construct windows, that contain the sequences of the different arms"""
+def create_windows_arrays(arm_1_start, arm_2_start, arm_3_starts, arm_4_starts, sequence_array, complementary_sequence_array, arm_size):
+    """Creating standard construct windows for all constructs of a center, one list per window"""
+    construct_count = len(arm_3_starts)
     
-    arm_1_sequence = sequence[arm_starts[0] : arm_starts[0] + arm_size]
-    arm_2_sequence = complementary_sequence[arm_starts[1] : arm_starts[1] + arm_size]
-    arm_3_sequence = complementary_sequence[arm_starts[2] : arm_starts[2] + arm_size]
-    arm_4_sequence = complementary_sequence[arm_starts[3] : arm_starts[3] + arm_size]
+    # Arms 1 and 2 are identical for all constructs of a center
+    arm_1_sequence = sequence_array[arm_1_start : arm_1_start + arm_size]
+    arm_2_sequence = complementary_sequence_array[arm_2_start : arm_2_start + arm_size]
     
-    window_1 = arm_2_sequence[::-1]
-    window_2 = arm_3_sequence
+    # Arms 3 and 4, one row per construct
+    complementary_arms = sliding_window_view(complementary_sequence_array, arm_size)
+    arm_3_sequences = complementary_arms[arm_3_starts]
+    arm_4_sequences = complementary_arms[arm_4_starts]
     
+    window_1 = arm_2_sequence[::-1]
     window_3 = arm_1_sequence
-    window_4 = arm_4_sequence
+    window_5 = np.concatenate([window_1, SEPARATOR_ARRAY, window_3])
+    window_6 = np.concatenate([arm_3_sequences, np.broadcast_to(SEPARATOR_ARRAY, (construct_count, len(SEPARATOR_ARRAY))), arm_4_sequences], axis=1)
     
-    window_5 = window_1 + "NNN" + window_3
-    window_6 = window_2 + "NNN" + window_4
+    windows = [
+        [window_1.tobytes().decode("ascii")] * construct_count,
+        byte_rows_to_strings(arm_3_sequences),
+        [window_3.tobytes().decode("ascii")] * construct_count,
+        byte_rows_to_strings(arm_4_sequences),
+        [window_5.tobytes().decode("ascii")] * construct_count,
+        byte_rows_to_strings(window_6)
+    ]
     
-    return [window_1, window_2, window_3, window_4, window_5, window_6]
+    return windows
 
 
 def arm_4_starts_for_fixed_arm_3(arm_3_start, sequence_length, arm_size, loop_2_maximal_size, loop_2_step_size):
@@ -49,6 +78,42 @@ def arm_3_starts_for_fixed_arm_2(arm_2_start, sequence_length, arm_size, loop_1_
     return arm_3_starts
 
 
+def arm_starts_for_center(arm_2_start, sequence_length, arm_size, loop_1_minimal_size, loop_1_step_size, loop_2_maximal_size, loop_2_step_size):
+    """Get arm 3 and arm 4 starts of all constructs of a center as two aligned arrays"""
+    arm_3_starts = np.array(arm_3_starts_for_fixed_arm_2(arm_2_start, sequence_length, arm_size, loop_1_minimal_size, loop_1_step_size), dtype=np.int64)
+    
+    # Same bounds as arm_4_starts_for_fixed_arm_3, computed for all arm 3 starts at once
+    arm_4_first_starts = arm_3_starts + arm_size
+    arm_4_stops = np.minimum(sequence_length + 1 - arm_size, arm_4_first_starts + loop_2_maximal_size + 1)
+    arm_4_counts = np.maximum(0, -((arm_4_first_starts - arm_4_stops) // loop_2_step_size))
+    
+    # Each arm 3 start is repeated once per arm 4 start, arm 4 starts are then stepped inside of each arm 3 group
+    construct_arm_3_starts = np.repeat(arm_3_starts, arm_4_counts)
+    group_first_indexes = np.repeat(np.cumsum(arm_4_counts) - arm_4_counts, arm_4_counts)
+    construct_arm_4_starts = construct_arm_3_starts + arm_size + (np.arange(len(construct_arm_3_starts)) - group_first_indexes) * loop_2_step_size
+    
+    return construct_arm_3_starts, construct_arm_4_starts
+
+
+def estimate_center_construct_count(center, sequence_length, arm_size, loop_1_minimal_size, loop_1_step_size, loop_2_maximal_size, loop_2_step_size):
+    """Number of constructs of a center, computed from the arm 3 start range without creating the constructs"""
+    # Same bounds as arm_3_starts_for_fixed_arm_2 and arm_starts_for_center
+    arm_3_starts = np.arange(center + 1 + arm_size + loop_1_minimal_size, sequence_length + 1 - arm_size * 2, loop_1_step_size, dtype=np.int64)
+    arm_4_stops = np.minimum(sequence_length + 1 - arm_size, arm_3_starts + arm_size + loop_2_maximal_size + 1)
+    
+    return int(np.maximum(0, -((arm_3_starts + arm_size - arm_4_stops) // loop_2_step_size)).sum())
+
+
+def schedule_centers(possible_centers, sequence_length, arm_size, loop_1_minimal_size, loop_1_step_size, loop_2_maximal_size, loop_2_step_size):
+    """Orders centers from the most to the least constructs, so that the biggest centers are not left for the end of the execution"""
+    # Note: Centers near the start of the subsequence have many more arm 3 positions than centers near its end
+    construct_counts = {
+        center: estimate_center_construct_count(center, sequence_length, arm_size, loop_1_minimal_size, loop_1_step_size, loop_2_maximal_size, loop_2_step_size)
+        for center in possible_centers
+    }
+    return sorted(possible_centers, key=lambda center: construct_counts[center], reverse=True)
+
+
 def find_possible_centers(sequence_length, arm_size, loop_1_minimal_size, center_step_size):
     """In a string of given size get the predictable amount of centers"""
     centers = list(
@@ -71,7 +136,63 @@ def arms_from_center(center, sequence_coordinates, arm_size):
     return center_coordinates, arm_1_start, arm_1_start_coordinates, arm_2_start, arm_2_start_coordinates
 
 
-def constructs_from_reference_sequence(instructions, return_queue):
+def construct_rows_for_center(center_ID, center, arm_3_starts, arm_4_starts, sequence_coordinates, arm_size, sequence_arrays):
+    """Creating the standard construct file rows of a center from its arm starts, windows are only created if sequence arrays are given"""
+    center_coordinates, arm_1_start, arm_1_start_coordinates, arm_2_start, arm_2_start_coordinates = arms_from_center(center, sequence_coordinates, arm_size)
+    arm_3_starts_coordinates = uf.get_reference_coordinates_array(arm_3_starts, sequence_coordinates)
+    arm_4_starts_coordinates = uf.get_reference_coordinates_array(arm_4_starts, sequence_coordinates)
+    construct_IDs = [uf.form_construct_ID(center_ID, arm_3_start, arm_4_start) for arm_3_start, arm_4_start in zip(arm_3_starts.tolist(), arm_4_starts.tolist())]
+    
+    windows = []
+    if sequence_arrays is not None:
+        windows = create_windows_arrays(arm_1_start, arm_2_start, arm_3_starts, arm_4_starts, sequence_arrays[0], sequence_arrays[1], arm_size)
+    
+    construct_count = len(construct_IDs)
+    return zip(
+        construct_IDs, [center_coordinates] * construct_count, [arm_1_start_coordinates] * construct_count, [arm_2_start_coordinates] * construct_count,
+        arm_3_starts_coordinates.tolist(), arm_4_starts_coordinates.tolist(),
+        *windows
+    )
+
+
+def materialize_virtual_constructs(center_ID, virtual_rows, sequence_coordinates, arm_size, sequence_arrays=None):
+    """Rebuilding standard construct rows from the rows of a virtual construct file"""
+    center = int(center_ID.split("-")[-1])
+    arm_starts = np.array(virtual_rows, dtype=np.int64).reshape(-1, 2)
+    
+    return construct_rows_for_center(center_ID, center, arm_starts[:, 0], arm_starts[:, 1], sequence_coordinates, arm_size, sequence_arrays)
+
+
+def virtual_construct_windows(center_ID, virtual_rows, arm_size, sequence_arrays):
+    """Keys and windows of the constructs of a virtual construct file, identifiers and coordinates are not created"""
+    center = int(center_ID.split("-")[-1])
+    arm_starts = np.array(virtual_rows, dtype=np.int64).reshape(-1, 2)
+    windows = create_windows_arrays(center - arm_size, center + 1, arm_starts[:, 0], arm_starts[:, 1], sequence_arrays[0], sequence_arrays[1], arm_size)
+    
+    return uf.form_construct_key(arm_starts[:, 0], arm_starts[:, 1]).tolist(), list(zip(*windows))
+
+
+def virtual_constructs_for_center(center_ID, sequence_length, construct_generation_specifications):
+    """Generating the rows of the virtual construct file of a center in memory, the arm 3 and arm 4 starts of its constructs"""
+    arm_2_start = int(center_ID.split("-")[-1]) + 1
+    arm_3_starts, arm_4_starts = arm_starts_for_center(
+        arm_2_start, sequence_length, construct_generation_specifications[uv.ARM_SIZE_KEY], construct_generation_specifications[uv.LOOP_1_MINIMAL_SIZE_KEY],
+        construct_generation_specifications[uv.LOOP_1_STEP_SIZE_KEY], construct_generation_specifications[uv.LOOP_2_MAXIMAL_SIZE_KEY], construct_generation_specifications[uv.LOOP_2_STEP_SIZE_KEY]
+    )
+    return np.column_stack((arm_3_starts, arm_4_starts))
+
+
+def load_reference_sequence_arrays(instructions):
+    """Loading the reference sequence of the execution as byte arrays that are shared by all materialized constructs"""
+    if cf.REFERENCE_SEQUENCE_STORE:
+        return rss.load_reference_store(instructions[uv.REFERENCE_SEQUENCE_KEY][0], instructions[uv.REFERENCE_SEQUENCE_KEY][1])
+    
+    sequence, complementary_sequence, sequence_coordinates = uf.load_reference_sequence(instructions[uv.REFERENCE_SEQUENCE_KEY][0], instructions[uv.REFERENCE_SEQUENCE_KEY][1])
+    
+    return (sequence_to_array(sequence), sequence_to_array(complementary_sequence)), sequence_coordinates
+
+
+def constructs_from_reference_sequence(instructions, return_connection):
     """Generates constructs from a given reference sequence"""
 
     # Preparing Execution associated variables
@@ -95,64 +216,60 @@ def constructs_from_reference_sequence(instructions, return_queue):
         os.mkdir(sequence_construct_folder_path)
     
     # Gathering sequence information
-    sequence, complementary_sequence, sequence_coordinates = uf.load_reference_sequence(reference_sequence_name, subsequence_name)
-    sequence_length = len(sequence)
+    (sequence_array, complementary_sequence_array), sequence_coordinates = load_reference_sequence_arrays(instructions)
+    sequence_length = len(sequence_array)
         
-    # Identifying all possible centers
+    manifest = cm.open_manifest()
+    
+    # Identifying all possible centers, the biggest ones are generated and passed to the next processes first
     possible_centers = find_possible_centers(sequence_length, arm_size, loop_1_minimal_size, center_step_size)
+    if cf.COST_AWARE_CENTER_SCHEDULING:
+        possible_centers = schedule_centers(possible_centers, sequence_length, arm_size, loop_1_minimal_size, loop_1_step_size, loop_2_maximal_size, loop_2_step_size)
         
     for i, center in enumerate(possible_centers):
             
         # Preparing center associated variables
         center_ID = uf.form_center_ID(sequence_ID, construct_generation_specification_ID, center)
         construct_file_path = f"{sequence_construct_folder_path}{center_ID}-CF.csv"
-        center_coordinates, arm_1_start, arm_1_start_coordinates, arm_2_start, arm_2_start_coordinates = arms_from_center(center, sequence_coordinates, arm_size)
+        arm_2_start = center + 1
+        
+        # Without persisted construct files, constructs are generated in memory by the processes that use them
+        if not cf.PERSIST_CONSTRUCT_FILES:
+            return_connection.send((PROCESS_NUMBER, center_ID))
+            continue
         
         # Verifying that constructs are not already identified, if there are we can pass the center to the next processes
-        if os.path.isfile(construct_file_path):
-            return_queue.put((PROCESS_NUMBER, center_ID))
+        if cm.center_completed(manifest, PROCESS_NUMBER, center_ID, construct_file_path):
+            return_connection.send((PROCESS_NUMBER, center_ID))
             continue
             
-        # Preparing construct file
-        uf.create_construct_file(construct_file_path)
-            
-        # Identifying potential arm 3 starts
-        arm_3_starts = arm_3_starts_for_fixed_arm_2(arm_2_start, sequence_length, arm_size, loop_1_minimal_size, loop_1_step_size)
-
-        for arm_3_start in arm_3_starts:
-                
-            # Preparing arm_3 related variables
-            arm_3_start_coordinates = uf.get_reference_coordinates(arm_3_start, sequence_coordinates)
-                
-            # Identifying potential arm 4 starts
-            arm_4_starts = arm_4_starts_for_fixed_arm_3(arm_3_start, sequence_length, arm_size, loop_2_maximal_size, loop_2_step_size)
-                
-            for arm_4_start in arm_4_starts:
-                
-                # Preparing arm_4 related variables
-                arm_4_start_coordinates = uf.get_reference_coordinates(arm_4_start, sequence_coordinates)
-                    
-                # Outputing information to construct file
-                construct_ID = uf.form_construct_ID(center_ID, arm_3_start, arm_4_start)
-                windows = create_windows([arm_1_start, arm_2_start, arm_3_start, arm_4_start], sequence, complementary_sequence, arm_size)
-                uf.dump_construct_file_line(
-                    construct_file_path,
-                    [
-                        construct_ID, center_coordinates, arm_1_start_coordinates, arm_2_start_coordinates, arm_3_start_coordinates, arm_4_start_coordinates,
-                        windows[0], windows[1], windows[2], windows[3], windows[4], windows[5]
-                    ]
-                )
+        # Identifying all constructs of the center at once
+        arm_3_starts, arm_4_starts = arm_starts_for_center(arm_2_start, sequence_length, arm_size, loop_1_minimal_size, loop_1_step_size, loop_2_maximal_size, loop_2_step_size)
+        
+        # Outputing information to construct file, virtual construct files only hold the arm starts, everything else is derived from the reference
+        if cf.VIRTUAL_CONSTRUCT_FILES:
+            construct_file = uf.create_virtual_construct_file(construct_file_path)
+            uf.dump_construct_file_lines(construct_file, zip(arm_3_starts.tolist(), arm_4_starts.tolist()))
+        else:
+            construct_file = uf.create_construct_file(construct_file_path)
+            uf.dump_construct_file_lines(
+                construct_file,
+                construct_rows_for_center(center_ID, center, arm_3_starts, arm_4_starts, sequence_coordinates, arm_size, (sequence_array, complementary_sequence_array))
+            )
             
         # All constructs for this center are generated we can thus pass the center to the next processes
-        return_queue.put((PROCESS_NUMBER, center_ID))
+        uf.commit_buffered_file(construct_file)
+        cm.record_completed_center(manifest, PROCESS_NUMBER, center_ID)
+        return_connection.send((PROCESS_NUMBER, center_ID))
         
-    return_queue.put((PROCESS_NUMBER, uv.DONE))
+    cm.close_manifest(manifest)
+    return_connection.send((PROCESS_NUMBER, uv.DONE))
             
 
-def run_process(instructions, task_queue, return_queue, error_queue):
+def run_process(instructions, task_queue, return_connection, error_queue):
     """Permits running process from controller and handling error catching"""
     try:
-        constructs_from_reference_sequence(instructions, return_queue)
+        constructs_from_reference_sequence(instructions, return_connection)
     except Exception as error:
         excecution_information = sys.exc_info()
         formatted_exception =  traceback.format_exception( *excecution_information)
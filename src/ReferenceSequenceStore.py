@@ -0,0 +1,68 @@
+import os
+import json
+import tempfile
+
+import numpy as np
+
+import UtilitiesVariables as uv
+import UtilitiesFunction as uf
+
+def reference_store_paths(reference_sequence_ID):
+    """Paths of the sequences array and of the information file of a reference subsequence in the store"""
+    return f"{uv.REFERENCE_STORE_FOLDER}{reference_sequence_ID}.npy", f"{uv.REFERENCE_STORE_FOLDER}{reference_sequence_ID}.json"
+
+
+def reference_store_source(sequence_name, subsequence_name):
+    """Describes what a stored subsequence is created from, a stored subsequence is only used while its source is unchanged"""
+    with open(uv.REFERENCE_SEQUENCE_INFORMATION_PATH, "r") as file:
+        reference_sequence_information = json.load(file)
+    fasta_path = f"{uv.SEQUENCE_FOLDER}{reference_sequence_information[sequence_name][uv.PATH]}"
+    fasta_status = os.stat(fasta_path)
+
+    return {
+        uv.PATH: fasta_path, uv.REFERENCE_STORE_FASTA_SIZE_KEY: fasta_status.st_size, uv.REFERENCE_STORE_FASTA_TIME_KEY: fasta_status.st_mtime_ns,
+        uv.SUBSEQUENCES: reference_sequence_information[sequence_name][uv.SUBSEQUENCES][subsequence_name]
+    }
+
+
+def create_reference_store(sequence_name, subsequence_name, source):
+    """Parsing a reference subsequence once and storing it with its complementary sequence as the two rows of a byte array"""
+    sequence, complementary_sequence, sequence_coordinates = uf.load_reference_sequence(sequence_name, subsequence_name)
+    sequences = np.frombuffer(f"{sequence}{complementary_sequence}".encode("ascii"), dtype=np.uint8).reshape(2, -1)
+
+    array_path, information_path = reference_store_paths(uf.form_reference_sequence_ID(sequence_name, subsequence_name))
+    os.makedirs(uv.REFERENCE_STORE_FOLDER, exist_ok=True)
+
+    # Note: Each process writes its own temporary files, which are then moved, processes creating the same subsequence at the same time never read a partial file
+    array_file_descriptor, temporary_array_path = tempfile.mkstemp(dir=uv.REFERENCE_STORE_FOLDER, suffix=uv.TEMPORARY_FILE_SUFFIX)
+    with os.fdopen(array_file_descriptor, "wb") as file:
+        np.save(file, sequences)
+    information_file_descriptor, temporary_information_path = tempfile.mkstemp(dir=uv.REFERENCE_STORE_FOLDER, suffix=uv.TEMPORARY_FILE_SUFFIX)
+    with os.fdopen(information_file_descriptor, "w") as file:
+        json.dump({uv.REFERENCE_STORE_SOURCE_KEY: source, uv.REFERENCE_STORE_COORDINATES_KEY: sequence_coordinates}, file)
+
+    # The array is moved before the information file, an information file matching its source is never next to an older array.
+    # If the execution stops in between, the old information file does not match the source and the subsequence is stored again.
+    os.replace(temporary_array_path, array_path)
+    os.replace(temporary_information_path, information_path)
+
+
+def load_reference_store(sequence_name, subsequence_name):
+    """Memory mapped byte arrays of a reference subsequence and of its complementary sequence, and the subsequence coordinates"""
+    array_path, information_path = reference_store_paths(uf.form_reference_sequence_ID(sequence_name, subsequence_name))
+    source = reference_store_source(sequence_name, subsequence_name)
+
+    # The subsequence is stored by the first process that needs it, or again if its fasta or subsequence instruction changed
+    information = None
+    if os.path.isfile(information_path):
+        with open(information_path, "r") as file:
+            information = json.load(file)
+    if information is None or information[uv.REFERENCE_STORE_SOURCE_KEY] != source:
+        create_reference_store(sequence_name, subsequence_name, source)
+        with open(information_path, "r") as file:
+            information = json.load(file)
+
+    # Note: All processes and their replicas map the same file, the sequences are read from the page cache without being copied
+    sequences = np.load(array_path, mmap_mode="r")
+
+    return (sequences[0], sequences[1]), information[uv.REFERENCE_STORE_COORDINATES_KEY]
@@ -2,71 +2,74 @@
 import os
 import sys
 import traceback
-import csv
 import time
+import bisect
+
+import numpy as np
+
 import UtilitiesVariables as uv
 import UtilitiesFunction as uf
+import Configuration as cf
+import ReferenceSequenceConstructGenerator as rscg
+import CompletionManifest as cm
 
 PROCESS_NUMBER = 4
 
-def add_variants_to_sequence(sequence, sequence_variants, complementary):
-    """Adding variant inside of arm sequences"""
-    modified_sequence = list(sequence)
+def patch_arm(strand_sequence, arm_start, arm_size, strand_variants, complementary):
+    """Cutting an arm out of a strand modified by the given variants, only the region around the arm is patched"""
+    # Note: Variants are applied in order as if the whole strand was modified, each variant before the region only
+    # shifts the region, variants inside of it are applied locally. Each variant moves bases by at most one position,
+    # so a margin of twice the number of variants on both sides of the arm keeps the arm inside of the region.
+    margin = 2 * len(strand_variants) + 1
+    region_start = max(0, arm_start - margin)
+    region = list(strand_sequence[region_start : arm_start + arm_size + margin])
     sequence_adjustment = 0
-    for sequence_variant in sequence_variants:
-        index = sequence_variant[0]
-        operation = sequence_variant[1]
-        index += sequence_adjustment
+    
+    for strand_variant in strand_variants:
+        index = strand_variant[0] + sequence_adjustment
+        operation = strand_variant[1]
+        region_index = index - region_start
         
         # Substitution, simple assigning character to the correct position
-        if operation == "S":
-            substituted_base = sequence_variant[2]
+        if operation == "S" and 0 <= region_index < len(region):
+            substituted_base = strand_variant[2]
             if complementary:
                 substituted_base = uv.COMPLEMENTARY_BASES[substituted_base]
-            modified_sequence[index] = substituted_base
+            region[region_index] = substituted_base
+        
         # Insertion, need to change adjustement so that following variants are placed at the correct emplacement
         if operation == "I":
-            inserted_base = sequence_variant[2]
-            if complementary:
-                inserted_base = uv.COMPLEMENTARY_BASES[inserted_base]
-            modified_sequence.insert(index, inserted_base)
             sequence_adjustment += 1
-            
+            if region_index < 0:
+                region_start += 1
+            elif region_index <= len(region):
+                inserted_base = strand_variant[2]
+                if complementary:
+                    inserted_base = uv.COMPLEMENTARY_BASES[inserted_base]
+                region.insert(region_index, inserted_base)
+        
         # deletion, need to change adjustement so that following variants are placed at the correct emplacement
         if operation == "D":
-            del modified_sequence[index]
             sequence_adjustment -= 1
+            if region_index < 0:
+                region_start -= 1
+            elif region_index < len(region):
+                del region[region_index]
     
-    modified_sequence = "".join(modified_sequence)
-    
-    return modified_sequence
+    return "".join(region[arm_start - region_start : arm_start - region_start + arm_size])
 
 
-def create_windows_from_relative_sequence(relative_sequence, arm_starts, sequence, complementary_sequence, arm_size):
+def create_windows_from_relative_sequence(arm_variants, arm_starts, sequence, complementary_sequence, arm_size):
     """Recreating windows for constructs that contain a variant"""
-    arm_variants = {0: [], 1: [] , 2: [], 3: []}
-    
-    for variant in relative_sequence:
-        if variant == "Overshot":
-            continue
-        for arm in range(4):
-            if arm_starts[arm]<= variant[0] and variant[0] < arm_starts[arm] + arm_size:
-                arm_variants[arm].append((variant))
-    
-    #Preparing whole sequence to be modified
+    # Preparing variants of each strand
     sequence_variants = arm_variants[0]
     complementary_sequence_variants = arm_variants[1] + arm_variants[2] + arm_variants[3]
     
-    # Modifing Light strand
-    sequence = add_variants_to_sequence(sequence, sequence_variants, False)
-    # Modifying hevy strand
-    complementary_sequence = add_variants_to_sequence(complementary_sequence, complementary_sequence_variants, True)
-    
-    # Retrieving arms
-    arm_1_sequence = sequence[arm_starts[0] : arm_starts[0] + arm_size]
-    arm_2_sequence = complementary_sequence[arm_starts[1] : arm_starts[1] + arm_size]
-    arm_3_sequence = complementary_sequence[arm_starts[2] : arm_starts[2] + arm_size]
-    arm_4_sequence = complementary_sequence[arm_starts[3] : arm_starts[3] + arm_size]
+    # Retrieving arms, light strand for arm 1 and heavy strand for the others
+    arm_1_sequence = patch_arm(sequence, arm_starts[0], arm_size, sequence_variants, False)
+    arm_2_sequence = patch_arm(complementary_sequence, arm_starts[1], arm_size, complementary_sequence_variants, True)
+    arm_3_sequence = patch_arm(complementary_sequence, arm_starts[2], arm_size, complementary_sequence_variants, True)
+    arm_4_sequence = patch_arm(complementary_sequence, arm_starts[3], arm_size, complementary_sequence_variants, True)
     
     # Creating Windows
     window_1 = arm_2_sequence[::-1]
@@ -79,7 +82,7 @@ def create_windows_from_relative_sequence(relative_sequence, arm_starts, sequenc
     return window_1, window_2, window_3, window_4, window_5, window_6
 
 
-def prepare_individuals(individuals, reference_sequence_ID, construct_generation_specification_id, relative_sequence_information, center, return_queue):
+def prepare_individuals(individuals, reference_sequence_ID, construct_generation_specification_id, relative_sequence_information, center, arm_size, manifest, return_connection):
     """Prepare variables and files for each individual"""
     individuals_variables = {}
     
@@ -89,16 +92,21 @@ def prepare_individuals(individuals, reference_sequence_ID, construct_generation
         
         new_center_id = uf.form_center_ID(relative_sequence_ID, construct_generation_specification_id, center)
         new_construct_file_path = f"{uv.CONSTRUCT_FOLDER}{relative_sequence_ID}{os.sep}{new_center_id}-CF.csv"
-        relative_sequence = relative_sequence_information[relative_sequence_ID]
+        variant_index = relative_sequence_information[relative_sequence_ID]
             
-        # Verifying that constructs are not already generated
-        if os.path.isfile(new_construct_file_path):
-            return_queue.put((PROCESS_NUMBER, new_center_id))
+        # Verifying that constructs are not already generated, constructs that are not persisted are always generated again
+        if cf.PERSIST_CONSTRUCT_FILES and cm.center_completed(manifest, PROCESS_NUMBER, new_center_id, new_construct_file_path):
+            return_connection.send((PROCESS_NUMBER, new_center_id))
             continue
         
-        uf.create_construct_file(new_construct_file_path)
+        # Arms 1 and 2 are shared by all constructs of the center
+        center_arm_variants = [
+            uf.variants_in_range(variant_index, center - arm_size, center),
+            uf.variants_in_range(variant_index, center + 1, center + 1 + arm_size)
+        ]
         
-        individuals_variables[relative_sequence_ID] = [new_center_id, new_construct_file_path, relative_sequence]
+        # Note: Relative constructs are few, they are kept until the center is done and then written in one block
+        individuals_variables[relative_sequence_ID] = [new_center_id, new_construct_file_path, variant_index, [], center_arm_variants]
     return individuals_variables
         
 
@@ -115,11 +123,9 @@ def create_construct_directories(new_pairs_to_treat, reference_sequence_ID):
             os.mkdir(f"{uv.CONSTRUCT_FOLDER}{relative_sequence_ID}")
 
 
-def load_relative_sequences(new_pairs_to_treat, reference_sequence_ID, reference_sequences_coordinates):
-    """Load relative sequences for all individuals that have been generated"""
+def load_relative_sequences(new_pairs_to_treat, reference_sequence_ID, reference_sequences_coordinates, relative_sequence_informations):
+    """Load relative sequences for all individuals that have been generated and are not loaded yet, as variant indexes"""
     
-    relative_sequence_informations = {}
-
     # Collecting all individuals that have been generated
     individuals = []
     for individuals_for_center in new_pairs_to_treat.values():
@@ -130,12 +136,137 @@ def load_relative_sequences(new_pairs_to_treat, reference_sequence_ID, reference
     
     for individual_ID in individuals:
         relative_sequence_ID = uf.form_relative_sequence_ID(reference_sequence_ID, individual_ID)
-        relative_sequence_informations[relative_sequence_ID] = uf.load_relative_sequence(f"{uv.SEQUENCE_FOLDER}Relative{os.sep}{individual_ID}.csv", reference_sequences_coordinates)
+        if relative_sequence_ID in relative_sequence_informations:
+            continue
+        relative_sequence = uf.load_relative_sequence(f"{uv.SEQUENCE_FOLDER}Relative{os.sep}{individual_ID}.csv", reference_sequences_coordinates)
+        relative_sequence_informations[relative_sequence_ID] = uf.build_variant_index(relative_sequence)
+
+
+def add_relative_construct(variables, arm_variants, center, arm_3_start, arm_4_start, coordinates, sequence, complementary_sequence, arm_size):
+    """Adding a construct containing variants to the constructs of an individual"""
+    # Modiyfing windows according to relative sequence
+    windows = create_windows_from_relative_sequence(arm_variants, [center - arm_size, center + 1, arm_3_start, arm_4_start], sequence, complementary_sequence, arm_size)
+    
+    # Constructs passed directly to the energies calculation only need their key and windows
+    if not cf.PERSIST_CONSTRUCT_FILES:
+        variables[3].append((uf.form_construct_key(arm_3_start, arm_4_start), windows))
+        return
+    
+    new_construct_id = uf.form_construct_ID(variables[0], arm_3_start, arm_4_start)
+    variables[3].append(
+        [new_construct_id, coordinates[0], coordinates[1], coordinates[2], coordinates[3], coordinates[4],
+        windows[0], windows[1], windows[2], windows[3], windows[4], windows[5]]
+    )
+
+
+def arm_variants_for_construct(variables, arm_3_start, arm_4_start, arm_size):
+    """Get the variants of an individual in each arm of a construct"""
+    variant_index = variables[2]
+    return variables[4] + [
+        uf.variants_in_range(variant_index, arm_3_start, arm_3_start + arm_size),
+        uf.variants_in_range(variant_index, arm_4_start, arm_4_start + arm_size)
+    ]
+
+
+def relative_constructs_from_reference_constructs(center_ID, center, construct_file_path, individuals_variables, sequence, complementary_sequence, reference_sequences_coordinates, construct_generation_specifications):
+    """Scanning all reference constructs of a center and keeping those that contain variants"""
+    arm_size = construct_generation_specifications[uv.ARM_SIZE_KEY]
+    # Virtual construct files are materialized without windows, only identifiers and coordinates are needed here
+    if cf.PERSIST_CONSTRUCT_FILES:
+        is_virtual, rows = uf.load_construct_file(construct_file_path)
+    else:
+        is_virtual, rows = True, rscg.virtual_constructs_for_center(center_ID, len(sequence), construct_generation_specifications)
+    if is_virtual:
+        arm_starts = np.array(rows, dtype=np.int64).reshape(-1, 2).tolist()
+        rows = rscg.materialize_virtual_constructs(center_ID, rows, reference_sequences_coordinates, arm_size)
+    else:
+        arm_starts = np.column_stack(uf.arm_starts_from_construct_key(uf.construct_keys_from_IDs([row[0] for row in rows]))).tolist()
     
-    return  relative_sequence_informations
+    # Construct defining variables are taken from the arm starts instead of splitting each construct ID
+    for (arm_3_start, arm_4_start), row in zip(arm_starts, rows):
+
+        for variables in individuals_variables.values():
+            
+            # Checking if construct needs to be recomputed
+            arm_variants = arm_variants_for_construct(variables, arm_3_start, arm_4_start, arm_size)
+            if any(len(variants) > 0 for variants in arm_variants):
+                add_relative_construct(variables, arm_variants, center, arm_3_start, arm_4_start, row[1:6], sequence, complementary_sequence, arm_size)
 
 
-def generate_relative_sequence_constructs(new_pairs_to_treat, instructions, return_queue):
+def grid_starts_in_range(first_start, stop, step_size, range_start, range_end):
+    """Starts of the grid first_start + k * step_size (below stop) that fall in [range_start, range_end)"""
+    lowest = max(first_start, range_start)
+    highest = min(stop, range_end)
+    if lowest >= highest:
+        return range(0)
+    
+    # Rounding up to the first start of the grid
+    first_grid_start = first_start - ((first_start - lowest) // step_size) * step_size
+    return range(first_grid_start, highest, step_size)
+
+
+def affected_arm_starts(center, variant_index, sequence_length, construct_generation_specifications):
+    """Identifying with coordinate arithmetic the (arm 3 start, arm 4 start) of the constructs of a center that contain a variant"""
+    arm_size = construct_generation_specifications[uv.ARM_SIZE_KEY]
+    loop_1_step_size = construct_generation_specifications[uv.LOOP_1_STEP_SIZE_KEY]
+    loop_2_step_size = construct_generation_specifications[uv.LOOP_2_STEP_SIZE_KEY]
+    loop_1_minimal_size = construct_generation_specifications[uv.LOOP_1_MINIMAL_SIZE_KEY]
+    loop_2_maximal_size = construct_generation_specifications[uv.LOOP_2_MAXIMAL_SIZE_KEY]
+    arm_2_start = center + 1
+    
+    # A variant in arm 1 or arm 2 affects all constructs of the center
+    if len(uf.variants_in_range(variant_index, center - arm_size, center)) > 0 or len(uf.variants_in_range(variant_index, arm_2_start, arm_2_start + arm_size)) > 0:
+        arm_3_starts, arm_4_starts = rscg.arm_starts_for_center(arm_2_start, sequence_length, arm_size, loop_1_minimal_size, loop_1_step_size, loop_2_maximal_size, loop_2_step_size)
+        return list(zip(arm_3_starts.tolist(), arm_4_starts.tolist()))
+    
+    # Same bounds as arm_3_starts_for_fixed_arm_2
+    arm_3_first_start = arm_2_start + arm_size + loop_1_minimal_size
+    arm_3_stop = sequence_length + 1 - arm_size * 2
+    
+    positions = variant_index[0]
+    affected = set()
+    for position in set(positions[bisect.bisect_left(positions, arm_3_first_start):]):
+        
+        # Constructs with the variant in arm 3, all of their arm 4 starts are affected
+        for arm_3_start in grid_starts_in_range(arm_3_first_start, arm_3_stop, loop_1_step_size, position - arm_size + 1, position + 1):
+            for arm_4_start in rscg.arm_4_starts_for_fixed_arm_3(arm_3_start, sequence_length, arm_size, loop_2_maximal_size, loop_2_step_size):
+                affected.add((arm_3_start, arm_4_start))
+        
+        # Constructs with the variant in arm 4, arm 4 starts between arm_3_start + arm_size and arm_3_start + arm_size + loop_2_maximal_size
+        for arm_3_start in grid_starts_in_range(arm_3_first_start, arm_3_stop, loop_1_step_size, position - arm_size * 2 - loop_2_maximal_size + 1, position - arm_size + 1):
+            arm_4_stop = min(sequence_length + 1 - arm_size, arm_3_start + arm_size + loop_2_maximal_size + 1)
+            for arm_4_start in grid_starts_in_range(arm_3_start + arm_size, arm_4_stop, loop_2_step_size, position - arm_size + 1, position + 1):
+                affected.add((arm_3_start, arm_4_start))
+    
+    # Keeping the order of the reference construct files
+    return sorted(affected)
+
+
+def relative_constructs_from_variants(center, individuals_variables, sequence, complementary_sequence, reference_sequences_coordinates, construct_generation_specifications):
+    """Generating the constructs of a center that contain variants directly from the variants, without reading reference constructs"""
+    arm_size = construct_generation_specifications[uv.ARM_SIZE_KEY]
+    center_coordinates, _, arm_1_start_coordinates, _, arm_2_start_coordinates = rscg.arms_from_center(center, reference_sequences_coordinates, arm_size)
+    
+    for variables in individuals_variables.values():
+        for arm_3_start, arm_4_start in affected_arm_starts(center, variables[2], len(sequence), construct_generation_specifications):
+            coordinates = [
+                center_coordinates, arm_1_start_coordinates, arm_2_start_coordinates,
+                uf.get_reference_coordinates(arm_3_start, reference_sequences_coordinates), uf.get_reference_coordinates(arm_4_start, reference_sequences_coordinates)
+            ]
+            arm_variants = arm_variants_for_construct(variables, arm_3_start, arm_4_start, arm_size)
+            add_relative_construct(variables, arm_variants, center, arm_3_start, arm_4_start, coordinates, sequence, complementary_sequence, arm_size)
+
+
+def load_reference_sequence_strings(instructions):
+    """Loading the reference sequence of the execution as strings, from the reference sequence store if it is used"""
+    if not cf.REFERENCE_SEQUENCE_STORE:
+        return uf.load_reference_sequence(instructions[uv.REFERENCE_SEQUENCE_KEY][0], instructions[uv.REFERENCE_SEQUENCE_KEY][1])
+    
+    sequence_arrays, sequence_coordinates = rscg.load_reference_sequence_arrays(instructions)
+    return sequence_arrays[0].tobytes().decode("ascii"), sequence_arrays[1].tobytes().decode("ascii"), sequence_coordinates
+
+
+def generate_relative_sequence_constructs(new_pairs_to_treat, instructions, reference_sequence, relative_sequence_information, manifest, return_connection):
     """Generating relative sequence constructs based on individual vairants and reference sequenc constructs"""
         
     # Preparing generation level variables
@@ -144,10 +275,9 @@ def generate_relative_sequence_constructs(new_pairs_to_treat, instructions, retu
     subsequence_name = instructions[uv.REFERENCE_SEQUENCE_KEY][1]
     arm_size = instructions[uv.CONSTRUCT_GENSPECS_KEY][uv.ARM_SIZE_KEY]
 
-    # Load sequences
-    sequence, complementary_sequence, reference_sequences_coordinates = uf.load_reference_sequence(reference_sequence_name, subsequence_name)
+    sequence, complementary_sequence, reference_sequences_coordinates = reference_sequence
     reference_sequence_ID = uf.form_reference_sequence_ID(reference_sequence_name, subsequence_name)
-    relative_sequence_information = load_relative_sequences(new_pairs_to_treat, reference_sequence_ID, reference_sequences_coordinates)
+    load_relative_sequences(new_pairs_to_treat, reference_sequence_ID, reference_sequences_coordinates, relative_sequence_information)
     
     create_construct_directories(new_pairs_to_treat, reference_sequence_ID)
     
@@ -158,57 +288,31 @@ def generate_relative_sequence_constructs(new_pairs_to_treat, instructions, retu
         construct_file_path = f"{sequence_construct_folder_path}{center_ID}-CF.csv"
         center = int(center_ID.split("-")[-1])
         
-        individuals_variables = prepare_individuals(individuals, reference_sequence_ID, construct_generation_specification_id, relative_sequence_information, center, return_queue)
+        individuals_variables = prepare_individuals(individuals, reference_sequence_ID, construct_generation_specification_id, relative_sequence_information, center, arm_size, manifest, return_connection)
         treated_new_center_IDs = []
         
-        with open(construct_file_path, "r") as file:
-            reader = csv.reader(file)
-            for i, row in enumerate(reader):
-                if i == 0:
-                    continue
-                    
-                # Gathering construct defining variables
-                construct_id = row[0]
-                arm_3_start = int(construct_id.split("-")[13])
-                arm_4_start = int(construct_id.split("-")[14])
-        
-                for relative_sequence_ID, variables  in individuals_variables.items():
-                    new_center_id = variables[0]
-                    new_construct_file_path = variables[1]
-                    relative_sequence = variables[2].copy()
-                    
-                    # Checking if construct needs to be recomputed
-                    change_in_arms = False
-                    for i, variant in enumerate(relative_sequence):
-                        
-                        if variant == "Overshot":
-                            continue
-                        
-                        if ( (variant[0] >= center - arm_size and variant[0] < center)
-                            or (variant[0] >= center + 1 and variant[0] <= center + arm_size) 
-                            or (variant[0] >= arm_3_start and variant[0] < arm_3_start + arm_size)
-                            or (variant[0] >= arm_4_start and variant[0] < arm_4_start + arm_size)
-                        ):
-                        
-                            change_in_arms = True
-                            break
-                        
-                        if variant[0] <= center - arm_size:
-                            individuals_variables[relative_sequence_ID][2][i] =  "Overshot"
-                    
-                    if change_in_arms:
-                        # Modiyfing windows according to relative sequence
-                        new_construct_id = uf.form_construct_ID(new_center_id, arm_3_start, arm_4_start)
-                        windows = create_windows_from_relative_sequence(relative_sequence, [center - arm_size, center + 1, arm_3_start, arm_4_start], sequence, complementary_sequence, arm_size)
-                        uf.dump_construct_file_line(
-                            new_construct_file_path, [new_construct_id, row[1] , row[2], row[3], row[4], row[5],
-                            windows[0], windows[1], windows[2], windows[3], windows[4], windows[5]]
-                        )
-        
+        # Identifying the constructs that contain variants for each individual
+        if cf.VARIANT_DRIVEN_RELATIVE_CONSTRUCTS:
+            relative_constructs_from_variants(center, individuals_variables, sequence, complementary_sequence, reference_sequences_coordinates, instructions[uv.CONSTRUCT_GENSPECS_KEY])
+        else:
+            relative_constructs_from_reference_constructs(center_ID, center, construct_file_path, individuals_variables, sequence, complementary_sequence, reference_sequences_coordinates, instructions[uv.CONSTRUCT_GENSPECS_KEY])
+    
         treated_new_center_IDs = [individuals_variables[relative_sequence_ID][0] for relative_sequence_ID in individuals_variables]        
         
+        # Without persisted construct files, constructs are passed directly to the energies calculation with the center
+        if not cf.PERSIST_CONSTRUCT_FILES:
+            for variables in individuals_variables.values():
+                return_connection.send((PROCESS_NUMBER, variables[0], variables[3]))
+            continue
+        
+        for variables in individuals_variables.values():
+            new_construct_file = uf.create_construct_file(variables[1])
+            uf.dump_construct_file_lines(new_construct_file, variables[3])
+            uf.commit_buffered_file(new_construct_file)
+            cm.record_completed_center(manifest, PROCESS_NUMBER, variables[0])
+
         for new_center_id in treated_new_center_IDs:
-            return_queue.put((PROCESS_NUMBER, new_center_id))
+            return_connection.send((PROCESS_NUMBER, new_center_id))
 
 
 def get_new_pairs_from_new_center(new_pairs, new_center, individuals_to_treat):
@@ -257,28 +361,34 @@ def get_new_individuals_to_treat(task_queue, individuals_to_treat, centers_to_tr
                 get_new_pairs_from_new_individual(new_pairs_to_treat, new_task[1], centers_to_treat)
   
 
-def relative_sequence_contruct_generation(instructions, task_queue, return_queue):
+def relative_sequence_contruct_generation(instructions, task_queue, return_connection):
     """Generates constructs from a given reference sequence and given individuals and variants"""
     
     # Preapring generation level variables
     proceses_done = [False, False]
     individuals_to_treat = []
     centers_to_treat = []
+    relative_sequence_information = {}
+    manifest = cm.open_manifest()
+    
+    # The reference sequence is loaded once for the whole process, not at every iteration
+    reference_sequence = load_reference_sequence_strings(instructions)
     
     while True: 
         new_pairs_to_treat = {}
         get_new_individuals_to_treat(task_queue, individuals_to_treat, centers_to_treat, new_pairs_to_treat, proceses_done)
-        generate_relative_sequence_constructs(new_pairs_to_treat, instructions, return_queue)
+        generate_relative_sequence_constructs(new_pairs_to_treat, instructions, reference_sequence, relative_sequence_information, manifest, return_connection)
 
         if proceses_done[0] and proceses_done[1]:
-            return_queue.put((PROCESS_NUMBER, uv.DONE))
+            cm.close_manifest(manifest)
+            return_connection.send((PROCESS_NUMBER, uv.DONE))
             break
 
 
-def run_process(instructions, task_queue, return_queue, error_queue):
+def run_process(instructions, task_queue, return_connection, error_queue):
     """Permits running process from controller and handling error catching"""
     try:
-        relative_sequence_contruct_generation(instructions, task_queue, return_queue)
+        relative_sequence_contruct_generation(instructions, task_queue, return_connection)
     except Exception as error:
         excecution_information = sys.exc_info()
         formatted_exception =  traceback.format_exception( *excecution_information)
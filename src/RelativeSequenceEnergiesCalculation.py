@@ -5,10 +5,10 @@ import SequenceEnergiesCalculator as sec
 
 PROCESS_NUMBER = 5
     
-def run_process(instructions, task_queue, return_queue, error_queue):
+def run_process(instructions, task_queue, return_connection, error_queue):
     """Permits running process from controller and handling error catching"""
     try:
-        sec.energies_from_sequence_constructs(PROCESS_NUMBER, task_queue, return_queue)
+        sec.energies_from_sequence_constructs(PROCESS_NUMBER, instructions, task_queue, return_connection)
              
     except Exception as error:
         excecution_information = sys.exc_info()
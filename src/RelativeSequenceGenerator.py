@@ -1,14 +1,24 @@
 import sys
 import json
 import csv
+import bisect
 import traceback
+import concurrent.futures
 
 import Bio.Align as ba
 
 import UtilitiesVariables as uv
 import UtilitiesFunction as uf
+import Configuration as cf
+import VcfCohortReader as vcr
+import FastaCohortReader as fcr
 
 PROCESS_NUMBER = 3
+PENDING_RECORDS_PER_WORKER = 2
+
+# Set once per alignment worker by initialise_alignment_worker
+ALIGNER = None
+REFERENCE_SEQUENCES = {}
 
 def variants_mergeable(current_variant, next_variant, reference_sequence):
     """Check if two differences can be merge into one"""
@@ -125,42 +135,166 @@ def cleanup_variants(variants, reference_sequence):
     return result
 
 
-def compare_subsequences(reference_sequence, individual_sequence):
-    """Align sequences with theb BioAlign library and identify variants"""
-    aligner = ba.PairwiseAligner()
-    alignments = aligner.align(reference_sequence, individual_sequence)
-    best_alignment = alignments[0]
-
+def variants_from_alignment(alignment, reference_offset):
+    """Identify variants in an alignment, positions are shifted by the offset of the aligned reference segment"""
     # If relative and reference base are different handling 1) Insertion (I) 2) Deletion (D) 3) Substitution (S)
     relative_sequence = []
     reference_coordinates_adjustement = 0
-    for i, (ref_base, rel_base) in enumerate(zip(best_alignment[0], best_alignment[1])):
+    for i, (ref_base, rel_base) in enumerate(zip(alignment[0], alignment[1])):
         if ref_base != rel_base:
             if ref_base == '-':
-                relative_sequence.append([i + 1 - reference_coordinates_adjustement, 'I', rel_base])
+                relative_sequence.append([reference_offset + i + 1 - reference_coordinates_adjustement, 'I', rel_base])
                 reference_coordinates_adjustement += 1
             elif rel_base == '-':
-                relative_sequence.append([i + 1 - reference_coordinates_adjustement, 'D'])
+                relative_sequence.append([reference_offset + i + 1 - reference_coordinates_adjustement, 'D'])
             else:
-                relative_sequence.append([i + 1 - reference_coordinates_adjustement, 'S', rel_base])
+                relative_sequence.append([reference_offset + i + 1 - reference_coordinates_adjustement, 'S', rel_base])
 
     return relative_sequence
 
 
-def relative_sequence_from_fasta(file_path, reference_sequence_name, reference_sequence_information):
-    """Create relative sequence from a fasta file format"""
-    # Load sequence
-    reference_sequence = uf.load_fasta(f"{uv.SEQUENCE_FOLDER}{reference_sequence_information[reference_sequence_name][uv.PATH]}")
+def compare_subsequences(reference_sequence, individual_sequence, aligner):
+    """Align sequences with theb BioAlign library and identify variants"""
+    alignments = aligner.align(reference_sequence, individual_sequence)
+    best_alignment = alignments[0]
+
+    return variants_from_alignment(best_alignment, 0)
+
+
+def unique_kmers(sequence, kmer_size):
+    """Positions of the k-mers that appear only once in a sequence"""
+    positions = {}
+    for i in range(len(sequence) - kmer_size + 1):
+        kmer = sequence[i : i + kmer_size]
+        positions[kmer] = -1 if kmer in positions else i
+    return {kmer: position for kmer, position in positions.items() if position >= 0}
+
+
+def chain_anchors(anchors):
+    """Keep the longest chain of anchors that is increasing in both sequences (anchors are sorted by individual position)"""
+    # Longest increasing subsequence on the reference positions
+    chain_ends = []
+    chain_end_indexes = []
+    previous_indexes = [-1] * len(anchors)
+    for i, (reference_position, _) in enumerate(anchors):
+        chain_length = bisect.bisect_left(chain_ends, reference_position)
+        if chain_length > 0:
+            previous_indexes[i] = chain_end_indexes[chain_length - 1]
+        if chain_length == len(chain_ends):
+            chain_ends.append(reference_position)
+            chain_end_indexes.append(i)
+        else:
+            chain_ends[chain_length] = reference_position
+            chain_end_indexes[chain_length] = i
     
-    # Load individual sequence
-    individual_sequence = uf.load_fasta(f"{uv.INDIVIDUALS_FOLDER}{file_path}")
+    chain = []
+    i = chain_end_indexes[-1] if len(chain_end_indexes) > 0 else -1
+    while i >= 0:
+        chain.append(anchors[i])
+        i = previous_indexes[i]
+    
+    return chain[::-1]
+
+
+def find_anchor_blocks(reference_sequence, individual_sequence, kmer_size):
+    """Find exactly matching blocks (reference start, individual start, length) shared by both sequences, using unique k-mers as anchors"""
+    reference_kmers = unique_kmers(reference_sequence, kmer_size)
+    individual_kmers = unique_kmers(individual_sequence, kmer_size)
+    anchors = sorted(
+        ((reference_kmers[kmer], individual_position) for kmer, individual_position in individual_kmers.items() if kmer in reference_kmers),
+        key=lambda anchor: anchor[1]
+    )
+    
+    # Merging chained anchors into non overlapping blocks
+    blocks = []
+    for reference_position, individual_position in chain_anchors(anchors):
+        if len(blocks) > 0:
+            last_reference_start, last_individual_start, last_length = blocks[-1]
+            
+            # Anchor on the same diagonal overlapping or touching the last block extends it
+            if (reference_position - individual_position == last_reference_start - last_individual_start
+                and reference_position <= last_reference_start + last_length):
+                blocks[-1] = (last_reference_start, last_individual_start, reference_position + kmer_size - last_reference_start)
+                continue
+            
+            # Otherwise the anchor is trimmed so that it starts after the last block in both sequences
+            trim = max(0, last_reference_start + last_length - reference_position, last_individual_start + last_length - individual_position)
+            if trim >= kmer_size:
+                continue
+            reference_position += trim
+            individual_position += trim
+            blocks.append((reference_position, individual_position, kmer_size - trim))
+        else:
+            blocks.append((reference_position, individual_position, kmer_size))
+    
+    return blocks
+
+
+def compare_gap(reference_segment, individual_segment, reference_offset, aligner):
+    """Identify variants between two segments situated between anchor blocks"""
+    if reference_segment == individual_segment:
+        return []
+    
+    # Segments that are missing on one side are pure insertions or deletions
+    if len(reference_segment) == 0:
+        return [[reference_offset + 1, 'I', base] for base in individual_segment]
+    if len(individual_segment) == 0:
+        return [[reference_offset + i + 1, 'D'] for i in range(len(reference_segment))]
+    
+    alignments = aligner.align(reference_segment, individual_segment)
+    return variants_from_alignment(alignments[0], reference_offset)
+
+
+def compare_subsequences_anchored(reference_sequence, individual_sequence, aligner):
+    """Identify variants by aligning only the divergent segments between exact k-mer anchors"""
+    blocks = find_anchor_blocks(reference_sequence, individual_sequence, cf.ANCHOR_KMER_SIZE)
+    
+    # Anchors stop exactly where the sequences diverge, inside of repeats this would force the position of indels.
+    # Blocks are thus shortened on both sides so that each gap is aligned with some of its identical context.
+    flank_size = cf.ANCHOR_KMER_SIZE
+    blocks = [
+        (reference_start + flank_size, individual_start + flank_size, length - 2 * flank_size)
+        for reference_start, individual_start, length in blocks if length > 2 * flank_size
+    ]
+    
+    # Closing the blocks so that the ends of the sequences are handled as any other gap
+    blocks.append((len(reference_sequence), len(individual_sequence), 0))
+    
+    relative_sequence = []
+    reference_position = 0
+    individual_position = 0
+    for block_reference_start, block_individual_start, block_length in blocks:
+        relative_sequence.extend(compare_gap(
+            reference_sequence[reference_position : block_reference_start],
+            individual_sequence[individual_position : block_individual_start],
+            reference_position,
+            aligner
+        ))
+        reference_position = block_reference_start + block_length
+        individual_position = block_individual_start + block_length
+    
+    return relative_sequence
+
 
-    relative_sequence = compare_subsequences(reference_sequence, individual_sequence)
+def relative_sequence_from_individual_sequence(individual_sequence, reference_sequence, aligner):
+    """Create relative sequence by aligning an individual sequence on its reference sequence"""
+    if cf.ALIGNMENT_MODE == uv.ANCHORED_ALIGNMENT:
+        relative_sequence = compare_subsequences_anchored(reference_sequence, individual_sequence, aligner)
+    else:
+        relative_sequence = compare_subsequences(reference_sequence, individual_sequence, aligner)
     relative_sequence = cleanup_variants(relative_sequence, reference_sequence)
     
     return relative_sequence
 
 
+def relative_sequence_from_fasta(file_path, reference_sequence, aligner):
+    """Create relative sequence from a fasta file format"""
+    # Load individual sequence
+    individual_sequence = uf.load_fasta(f"{uv.INDIVIDUALS_FOLDER}{file_path}")
+    
+    return relative_sequence_from_individual_sequence(individual_sequence, reference_sequence, aligner)
+
+
 def relative_sequence_from_csv(file_path):
     """Create relative sequence from a csv file format"""
     with open(f"{uv.INDIVIDUALS_FOLDER}{file_path}", "r") as file:
@@ -169,7 +303,70 @@ def relative_sequence_from_csv(file_path):
     return relative_sequence
 
 
-def relative_sequence_generation(instructions, return_queue):
+def initialise_alignment_worker(reference_sequences):
+    """Preparing the aligner and the reference sequences once for each worker"""
+    global ALIGNER, REFERENCE_SEQUENCES
+    ALIGNER = ba.PairwiseAligner()
+    REFERENCE_SEQUENCES = reference_sequences
+
+
+def generate_individual_relative_sequence(individual_ID, reference_sequence_name, file_path):
+    """Create and save the relative sequence of one individual"""
+    if ".fasta" in file_path:
+        relative_sequence = relative_sequence_from_fasta(file_path, REFERENCE_SEQUENCES[reference_sequence_name], ALIGNER)
+    elif ".csv" in file_path:
+        relative_sequence = relative_sequence_from_csv(file_path)
+    else:
+        raise Exception(f"Error, Format not supported, In: Relative Sequence generation, Individual {individual_ID}, file is not .csv, .fasta or .vcf")    
+
+    uf.dump_relative_sequence(individual_ID, relative_sequence)
+    
+    return [individual_ID]
+
+
+def generate_record_relative_sequence(individual_ID, reference_sequence_name, individual_sequence):
+    """Create and save the relative sequence of one individual read from a multi-record fasta file"""
+    relative_sequence = relative_sequence_from_individual_sequence(individual_sequence, REFERENCE_SEQUENCES[reference_sequence_name], ALIGNER)
+    uf.dump_relative_sequence(individual_ID, relative_sequence)
+    
+    return [individual_ID]
+
+
+def generate_cohort_relative_sequences(file_path, individual_samples):
+    """Create and save the relative sequences of all individuals of a multi-sample vcf file, reading it only once"""
+    relative_sequences = vcr.relative_sequences_from_vcf(f"{uv.INDIVIDUALS_FOLDER}{file_path}", list(individual_samples.values()))
+    
+    for individual_ID, sample_name in individual_samples.items():
+        uf.dump_relative_sequence(individual_ID, sorted(relative_sequences[sample_name], key=lambda variant: variant[0]))
+    
+    return list(individual_samples)
+
+
+def load_reference_sequences(individuals, individuals_information):
+    """Load once every reference sequence needed to align the individuals"""
+    with open(uv.REFERENCE_SEQUENCE_INFORMATION_PATH, "r") as file:
+        reference_sequence_information = json.load(file)
+    
+    reference_sequences = {}
+    for individual_ID in individuals:
+        reference_sequence_name = individuals_information[individual_ID][0]
+        if reference_sequence_name not in reference_sequences:
+            reference_sequences[reference_sequence_name] = uf.load_fasta(f"{uv.SEQUENCE_FOLDER}{reference_sequence_information[reference_sequence_name][uv.PATH]}")
+    
+    return reference_sequences
+
+
+def report_finished_individuals(pending_futures, return_connection, timeout=None):
+    """Waits for at least one finished relative sequence (or at most the timeout) and passes the individuals of all finished ones to the next processes, returns the futures still pending"""
+    finished_futures, pending_futures = concurrent.futures.wait(pending_futures, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+    for future in finished_futures:
+        for individual_ID in future.result():
+            return_connection.send((PROCESS_NUMBER, individual_ID))
+    
+    return pending_futures
+
+
+def relative_sequence_generation(instructions, return_connection):
     """Create relative sequences from different type of input files in order to have a standrad format that can be used in the rest of the application"""
     # Gathering individuals
     individuals = instructions[uv.INDIVIDUALS_KEY]
@@ -178,33 +375,65 @@ def relative_sequence_generation(instructions, return_queue):
     with open(uv.INDIVIDUALS_INFORMATION_PATH, "r") as file:
         individuals_information = json.load(file)
     
+    reference_sequences = load_reference_sequences(individuals, individuals_information)
+    
+    # Individuals of a same vcf or multi-record fasta file are gathered so that each file is read only once
+    # Note: The sample (or record) name is the individual ID for individuals that were not registered with one
+    cohorts = {}
+    fasta_cohorts = {}
+    single_file_individuals = []
     for individual_ID in individuals:
-        
-        reference_sequence_name = individuals_information[individual_ID][0]
-        file_path = individuals_information[individual_ID][1]
+        individual_information = individuals_information[individual_ID]
+        sample_name = individual_information[2] if len(individual_information) > 2 else individual_ID
+        if ".vcf" in individual_information[1]:
+            cohorts.setdefault(individual_information[1], {})[individual_ID] = sample_name
+        elif ".fasta" in individual_information[1] and len(individual_information) > 2:
+            fasta_cohorts.setdefault(individual_information[1], {})[sample_name] = individual_ID
+        else:
+            single_file_individuals.append(individual_ID)
     
-        # Load sequence information
-        with open(uv.REFERENCE_SEQUENCE_INFORMATION_PATH, "r") as file:
-            reference_sequence_information = json.load(file)
+    # Individuals are aligned in parallel, each one is passed to the next processes as soon as it is done
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=cf.NCPUS_FOR_RELATIVE_SEQUENCE_GENERATION, initializer=initialise_alignment_worker, initargs=(reference_sequences,)
+    ) as executor:
+        pending_futures = set(
+            executor.submit(generate_individual_relative_sequence, individual_ID, individuals_information[individual_ID][0], individuals_information[individual_ID][1])
+            for individual_ID in single_file_individuals
+        )
+        pending_futures.update(
+            executor.submit(generate_cohort_relative_sequences, file_path, individual_samples)
+            for file_path, individual_samples in cohorts.items()
+        )
         
-        if ".fasta" in file_path:
-            relative_sequence = relative_sequence_from_fasta(file_path, reference_sequence_name, reference_sequence_information)
-        elif ".csv":
-            relative_sequence = relative_sequence_from_csv(file_path)
-        else:
-            raise Exception(f"Error, Format not supported, In: Relative Sequence generation, Individual {individual_ID}, file is not .csv or .fasta")    
-
-        uf.dump_relative_sequence(individual_ID, relative_sequence)
+        # Multi-record fasta files are streamed, the number of records waiting for a worker is bounded so that memory does not depend on the file size
+        maximal_pending_futures = len(pending_futures) + cf.NCPUS_FOR_RELATIVE_SEQUENCE_GENERATION * PENDING_RECORDS_PER_WORKER
+        for file_path, record_individuals in fasta_cohorts.items():
+            for record_name, individual_sequence in fcr.fasta_records(f"{uv.INDIVIDUALS_FOLDER}{file_path}"):
+                if record_name not in record_individuals:
+                    continue
+                individual_ID = record_individuals.pop(record_name)
+                
+                # Note: Individuals already done are passed without waiting, not only once the bound on pending records is reached
+                pending_futures = report_finished_individuals(pending_futures, return_connection, timeout=0)
+                while len(pending_futures) >= maximal_pending_futures:
+                    pending_futures = report_finished_individuals(pending_futures, return_connection)
+                pending_futures.add(
+                    executor.submit(generate_record_relative_sequence, individual_ID, individuals_information[individual_ID][0], individual_sequence)
+                )
+            
+            if len(record_individuals) > 0:
+                raise Exception(f"Error, In: Relative Sequence generation, records {sorted(record_individuals)} are not in {file_path}")
         
-        return_queue.put((PROCESS_NUMBER, individual_ID))
+        while pending_futures:
+            pending_futures = report_finished_individuals(pending_futures, return_connection)
             
-    return_queue.put((PROCESS_NUMBER, "Done"))
+    return_connection.send((PROCESS_NUMBER, "Done"))
 
 
-def run_process(instructions, task_queue, return_queue, error_queue):
+def run_process(instructions, task_queue, return_connection, error_queue):
     """Permits running process from controller and handling error catching"""
     try:
-        relative_sequence_generation(instructions, return_queue)
+        relative_sequence_generation(instructions, return_connection)
 
     except Exception as error:
         excecution_information = sys.exc_info()
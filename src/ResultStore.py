@@ -0,0 +1,105 @@
+import os
+import csv
+import json
+import sqlite3
+
+import UtilitiesVariables as uv
+
+# Opened once per process by result_store_connection
+CONNECTION = None
+CONNECTION_PROCESS_ID = None
+
+def result_store_connection():
+    """Connection of the current process to the result store, opening (and creating if needed) the store on first use"""
+    global CONNECTION, CONNECTION_PROCESS_ID
+    # Note: A connection can not be shared with forked processes, each process opens its own
+    if CONNECTION is None or CONNECTION_PROCESS_ID != os.getpid():
+        CONNECTION = sqlite3.connect(uv.RESULT_STORE_PATH, timeout=60)
+        CONNECTION_PROCESS_ID = os.getpid()
+        # Write ahead logging permits all processes to read and write the store at the same time
+        CONNECTION.execute("PRAGMA journal_mode=WAL")
+        CONNECTION.execute("PRAGMA synchronous=NORMAL")
+        CONNECTION.execute(
+            "CREATE TABLE IF NOT EXISTS centers (kind TEXT NOT NULL, center_ID TEXT NOT NULL, sequence_ID TEXT NOT NULL, construct_generation_specification_ID TEXT NOT NULL, center INTEGER NOT NULL, first_line TEXT NOT NULL, PRIMARY KEY (kind, center_ID)) WITHOUT ROWID"
+        )
+        CONNECTION.execute(
+            "CREATE TABLE IF NOT EXISTS center_rows (kind TEXT NOT NULL, sequence_ID TEXT NOT NULL, construct_generation_specification_ID TEXT NOT NULL, center INTEGER NOT NULL, arm_3_start INTEGER NOT NULL, arm_4_start INTEGER NOT NULL, row TEXT NOT NULL, PRIMARY KEY (kind, sequence_ID, construct_generation_specification_ID, center, arm_3_start, arm_4_start)) WITHOUT ROWID"
+        )
+        CONNECTION.commit()
+    return CONNECTION
+
+
+def row_arm_starts(row, is_virtual):
+    """Arm 3 and arm 4 starts of a row, read from the construct ID or directly for virtual construct rows"""
+    if is_virtual:
+        return int(row[0]), int(row[1])
+    construct_ID_parts = str(row[0]).split("-")
+    return int(construct_ID_parts[-2]), int(construct_ID_parts[-1])
+
+
+def store_center_rows(center_key, first_line, rows):
+    """Replacing all rows of a center in one transaction, a center is either completely stored or not at all"""
+    kind, center_ID, sequence_ID, construct_generation_specification_ID, center = center_key
+    is_virtual = first_line == uv.VIRTUAL_CONSTRUCT_FILE_FIRST_LINE
+    connection = result_store_connection()
+
+    with connection:
+        connection.execute("DELETE FROM center_rows WHERE kind = ? AND sequence_ID = ? AND construct_generation_specification_ID = ? AND center = ?", (kind, sequence_ID, construct_generation_specification_ID, center))
+        # Note: Values are stored as the csv writer would write them, loaded rows are identical to the rows of a csv file
+        connection.executemany(
+            "INSERT OR REPLACE INTO center_rows VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (kind, sequence_ID, construct_generation_specification_ID, center, *row_arm_starts(row, is_virtual), json.dumps(["" if value is None else str(value) for value in row]))
+                for row in rows
+            ]
+        )
+        connection.execute("INSERT OR REPLACE INTO centers VALUES (?, ?, ?, ?, ?, ?)", (*center_key, json.dumps(first_line)))
+
+
+def center_stored(center_key):
+    """Check if a center is in the result store"""
+    connection = result_store_connection()
+    row = connection.execute("SELECT 1 FROM centers WHERE kind = ? AND center_ID = ?", (center_key[0], center_key[1])).fetchone()
+    return row is not None
+
+
+def load_center_rows(center_key):
+    """Loading the first line and the rows of a center, ordered by arm 3 and arm 4 starts"""
+    kind, center_ID, sequence_ID, construct_generation_specification_ID, center = center_key
+    connection = result_store_connection()
+
+    first_line = connection.execute("SELECT first_line FROM centers WHERE kind = ? AND center_ID = ?", (kind, center_ID)).fetchone()
+    if first_line is None:
+        raise Exception(f"Error, In: Result store, center {center_ID} is not in the {kind} of the result store")
+    rows = connection.execute(
+        "SELECT row FROM center_rows WHERE kind = ? AND sequence_ID = ? AND construct_generation_specification_ID = ? AND center = ? ORDER BY arm_3_start, arm_4_start",
+        (kind, sequence_ID, construct_generation_specification_ID, center)
+    )
+
+    return json.loads(first_line[0]), [json.loads(row[0]) for row in rows]
+
+
+def export_to_csv():
+    """Writing every center of the result store to its csv file, in the same folders as without the result store"""
+    connection = result_store_connection()
+    center_keys = connection.execute("SELECT kind, center_ID, sequence_ID, construct_generation_specification_ID, center FROM centers").fetchall()
+
+    for center_key in center_keys:
+        kind, center_ID, sequence_ID = center_key[:3]
+        folder_path = f"{uv.RESULT_STORE_KINDS[kind]}{sequence_ID}{os.sep}"
+        if not os.path.isdir(folder_path):
+            os.mkdir(folder_path)
+
+        first_line, rows = load_center_rows(center_key)
+        with open(f"{folder_path}{center_ID}{kind}", "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(first_line)
+            writer.writerows(rows)
+
+    return len(center_keys)
+
+
+if __name__ == "__main__":
+
+    # Usage: python ResultStore.py, exports all centers of the result store to csv files
+    print(f"{export_to_csv()} centers exported from {uv.RESULT_STORE_PATH}")
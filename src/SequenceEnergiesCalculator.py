@@ -1,16 +1,26 @@
 
 import os
-import csv
 import RNA
+import logging
 import concurrent.futures
 
+import numpy as np
+
 import UtilitiesVariables as uv
 import UtilitiesFunction as uf
 import Configuration as cf
+import DuplexEnergyCache as dec
+import CompletionManifest as cm
+import ReferenceSequenceConstructGenerator as rscg
+
+logger = logging.getLogger(__name__)
 
-def calculate_construct_energy(construct_id, window_sextuplet):
+CHUNKS_PER_WORKER = 4
+MINIMAL_CHUNK_SIZE = 16
+MAXIMAL_CHUNK_SIZE = 4096
+
+def calculate_construct_energy(window_sextuplet):
     """Calculate energy based on pairing of the construct windows"""
-    test = f"{construct_id.split('-')[-2]}-{construct_id.split('-')[-1]}"
     # Process for window pair 1, left
     energy_left = RNA.duplexfold(window_sextuplet[0], window_sextuplet[1]).energy
         
@@ -19,83 +29,261 @@ def calculate_construct_energy(construct_id, window_sextuplet):
     
     # Process for window pair 3, std
     energy = RNA.duplexfold(window_sextuplet[4], window_sextuplet[5]).energy
-    return construct_id, (energy_left, energy_right, energy)
+    return energy_left, energy_right, energy
 
 
-def constructs_parallel_thread(constructs):
-    """Calculating energies """
-    results = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=cf.NCPUS_FOR_ENERGY_CALCULATIONS) as executor:
-        futures = [executor.submit(calculate_construct_energy, construct_ID, sextuplet) for construct_ID, sextuplet in constructs.items()]
+def calculate_window_pair_energy(window_pair):
+    """Calculate energy based on pairing of two windows"""
+    return RNA.duplexfold(window_pair[0], window_pair[1]).energy
 
-        for future in concurrent.futures.as_completed(futures):
-            result = future.result()
-            results[result[0]] = result[1]
-                
-    return results
 
+def window_pairs_from_sextuplet(window_sextuplet):
+    """Get the left, right and combined window pairs of a construct"""
+    return (window_sextuplet[0], window_sextuplet[1]), (window_sextuplet[2], window_sextuplet[3]), (window_sextuplet[4], window_sextuplet[5])
+
+
+def energy_pool_size(process_number):
+    """Number of energy workers of a process replica, according to the share of the energy calculation CPUs of the process"""
+    return max(1, round(cf.NCPUS_FOR_ENERGY_CALCULATIONS * cf.ENERGY_CALCULATION_CPU_SHARE[process_number] / cf.PROCESS_REPLICAS.get(process_number, 1)))
+
+
+def adaptive_chunk_size(task_count, pool_size):
+    """Chunk size giving each worker a few chunks, small batches keep workers balanced, big batches limit the transfer overhead"""
+    chunk_size = task_count // (pool_size * CHUNKS_PER_WORKER)
+    return min(MAXIMAL_CHUNK_SIZE, max(MINIMAL_CHUNK_SIZE, chunk_size))
+
+
+def folded_window_pair_energies(window_pairs, executor, pool_size):
+    """Calculating energies of window pairs, energies are yielded in the order of the window pairs as soon as their chunk is folded"""
+    chunk_size = adaptive_chunk_size(len(window_pairs), pool_size)
+    return executor.map(calculate_window_pair_energy, window_pairs, chunksize=chunk_size)
+
+
+def centers_factorized_process_pool(centers_window_sextuplets, energy_cache, executor, pool_size):
+    """Calculating energies, folding each unique window pair only once, the energies of each center are yielded once its window pairs are folded"""
+    # Note: The left energy only depends on arm 2 and arm 3 and the right energy only on arm 1 and arm 4.
+    # For a given center arm 1 and arm 2 are fixed, so these pairs are shared by many constructs.
+    centers_window_pairs = []
+    for window_sextuplets in centers_window_sextuplets:
+        window_pairs = set()
+        for sextuplet in window_sextuplets:
+            window_pairs.update(window_pairs_from_sextuplet(sextuplet))
+        centers_window_pairs.append(window_pairs)
+
+    # Only folding window pairs that have never been folded before
+    window_pair_energies = {}
+    if energy_cache is not None:
+        window_pair_energies = dec.get_cached_energies(energy_cache, set().union(*centers_window_pairs))
+
+    # Window pairs are folded center after center, a window pair shared by several centers is folded with the first of them
+    planned_window_pairs = set(window_pair_energies)
+    centers_window_pairs_to_fold = []
+    for window_pairs in centers_window_pairs:
+        center_window_pairs_to_fold = [window_pair for window_pair in window_pairs if window_pair not in planned_window_pairs]
+        planned_window_pairs.update(center_window_pairs_to_fold)
+        centers_window_pairs_to_fold.append(center_window_pairs_to_fold)
 
-def get_new_centers(task_queue):
-    """Extracts new centers to treat from task queue"""
+    energies = folded_window_pair_energies([window_pair for window_pairs in centers_window_pairs_to_fold for window_pair in window_pairs], executor, pool_size)
+    for window_sextuplets, center_window_pairs_to_fold in zip(centers_window_sextuplets, centers_window_pairs_to_fold):
+        new_window_pair_energies = {window_pair: next(energies) for window_pair in center_window_pairs_to_fold}
+        if energy_cache is not None:
+            dec.store_energies(energy_cache, new_window_pair_energies)
+        window_pair_energies.update(new_window_pair_energies)
+
+        yield [tuple(window_pair_energies[window_pair] for window_pair in window_pairs_from_sextuplet(sextuplet)) for sextuplet in window_sextuplets]
+
+
+def centers_process_pool(centers_window_sextuplets, energy_cache, executor, pool_size):
+    """Calculating energies construct by construct, the energies of each center are yielded once its constructs are folded"""
+    # Constructs whose three window pairs were all folded before are not folded again
+    window_pair_energies = {}
+    if energy_cache is not None:
+        window_pairs = set()
+        for window_sextuplets in centers_window_sextuplets:
+            for sextuplet in window_sextuplets:
+                window_pairs.update(window_pairs_from_sextuplet(sextuplet))
+        window_pair_energies = dec.get_cached_energies(energy_cache, window_pairs)
+    
+    centers_window_sextuplets_to_fold = [
+        [sextuplet for sextuplet in window_sextuplets if any(window_pair not in window_pair_energies for window_pair in window_pairs_from_sextuplet(sextuplet))]
+        for window_sextuplets in centers_window_sextuplets
+    ]
+    window_sextuplets_to_fold = [sextuplet for window_sextuplets in centers_window_sextuplets_to_fold for sextuplet in window_sextuplets]
+    chunk_size = adaptive_chunk_size(len(window_sextuplets_to_fold), pool_size)
+    energies = executor.map(calculate_construct_energy, window_sextuplets_to_fold, chunksize=chunk_size)
+
+    for window_sextuplets, window_sextuplets_to_fold in zip(centers_window_sextuplets, centers_window_sextuplets_to_fold):
+        new_window_pair_energies = {}
+        for sextuplet in window_sextuplets_to_fold:
+            new_window_pair_energies.update(zip(window_pairs_from_sextuplet(sextuplet), next(energies)))
+        if energy_cache is not None:
+            dec.store_energies(energy_cache, new_window_pair_energies)
+        window_pair_energies.update(new_window_pair_energies)
+
+        yield [tuple(window_pair_energies[window_pair] for window_pair in window_pairs_from_sextuplet(sextuplet)) for sextuplet in window_sextuplets]
+
+
+def get_new_centers(task_queue, maximal_centers, streamed_constructs):
+    """Extracts new centers to treat from task queue, at most maximal_centers if it is given"""
     new_constructs = []
     process_done = False
     
-    while not task_queue.empty():
-        new_task = task_queue.get()
+    # Waiting for the first task instead of polling an empty queue, idle replicas would otherwise take CPU time from the working ones
+    new_task = task_queue.get()
+    while True:
         if new_task[1] == uv.DONE:
+            # Note: Replicas share the task queue and each one receives its own done signal, it must leave the others to them
             process_done = True
-        else:
-            new_constructs.append(new_task[1])
+            break
+        new_constructs.append(new_task[1])
+        
+        # Constructs that were not persisted are carried by the task
+        if len(new_task) > 2:
+            streamed_constructs[new_task[1]] = new_task[2]
+        
+        if task_queue.empty() or (maximal_centers is not None and len(new_constructs) >= maximal_centers):
+            break
+        new_task = task_queue.get()
     return new_constructs, process_done
 
 
-def energies_from_sequence_constructs(process_number, task_queue, return_queue):
+def load_center_constructs(sequence_ID, center_ID, instructions, reference_sequence, streamed_constructs):
+    """Gathering constructs information of a center, the construct keys and the window sextuplets of the constructs"""
+    # Note: Constructs are identified by their key inside of the center, construct IDs are only formed in the energy file
+    if center_ID in streamed_constructs:
+        streamed_center_constructs = streamed_constructs.pop(center_ID)
+        return [construct[0] for construct in streamed_center_constructs], [construct[1] for construct in streamed_center_constructs]
+    
+    if cf.PERSIST_CONSTRUCT_FILES:
+        is_virtual, rows = uf.load_construct_file(f"{uv.CONSTRUCT_FOLDER}{sequence_ID}{os.sep}{center_ID}-CF.csv")
+    else:
+        is_virtual, rows = True, None
+    
+    # Windows of virtual constructs are rebuilt from the reference sequence, which is loaded once for the whole process
+    if is_virtual:
+        if len(reference_sequence) == 0:
+            reference_sequence.extend(rscg.load_reference_sequence_arrays(instructions))
+        sequence_arrays = reference_sequence[0]
+        
+        # Reference constructs that were not persisted are generated again, generation and folding are fused in this process
+        if rows is None:
+            rows = rscg.virtual_constructs_for_center(center_ID, len(sequence_arrays[0]), instructions[uv.CONSTRUCT_GENSPECS_KEY])
+        return rscg.virtual_construct_windows(center_ID, rows, instructions[uv.CONSTRUCT_GENSPECS_KEY][uv.ARM_SIZE_KEY], sequence_arrays)
+    
+    construct_keys = uf.construct_keys_from_IDs([row[0] for row in rows]).tolist()
+    return construct_keys, [(row[6], row[7], row[8], row[9], row[10], row[11]) for row in rows]
+
+
+def centers_energies(centers_window_sextuplets, energy_cache, executor, pool_size):
+    """Launching parallel computation of the energies of the constructs of centers, yields the energies of each center in order as soon as they are calculated"""
+    if cf.FACTORIZED_ENERGY_CALCULATION:
+        return centers_factorized_process_pool(centers_window_sextuplets, energy_cache, executor, pool_size)
+    return centers_process_pool(centers_window_sextuplets, energy_cache, executor, pool_size)
+
+
+def dump_constructs_energies(energy_file, center_ID, construct_keys, results):
+    """Outputing results of constructs to energy file"""
+    arm_3_starts, arm_4_starts = uf.arm_starts_from_construct_key(np.array(construct_keys, dtype=np.int64))
+    for arm_3_start, arm_4_start, energies in zip(arm_3_starts.tolist(), arm_4_starts.tolist(), results):
+        uf.dump_energy_file_line(
+            energy_file, 
+            [
+                uf.form_construct_ID(center_ID, arm_3_start, arm_4_start), energies[0], energies[1], energies[2]
+            ]
+        )
+
+
+def energies_from_center_batch(process_number, center_batch, energy_cache, executor, pool_size, manifest, return_connection):
+    """Calculates energies of a batch of centers at once and outputs them center by center"""
+    # Launching parallel computation of all constructs of the batch
+    results = centers_energies([center_window_sextuplets for _, (_, center_window_sextuplets) in center_batch.values()], energy_cache, executor, pool_size)
+
+    # Each center is committed and passed to the next processes as soon as its energies are calculated, not once the whole batch is
+    for (center_ID, (energy_file_path, (construct_keys, _))), center_results in zip(center_batch.items(), results):
+        
+        # Outputing results to energy file
+        energy_file = uf.create_energy_file(energy_file_path)
+        dump_constructs_energies(energy_file, center_ID, construct_keys, center_results)
+        uf.commit_buffered_file(energy_file)
+        cm.record_completed_center(manifest, process_number, center_ID)
+        
+        return_connection.send((process_number, center_ID))
+
+
+def energies_from_large_center(process_number, center_ID, energy_file_path, center_constructs, energy_cache, executor, pool_size, manifest, return_connection):
+    """Calculates energies of a center that is bigger than a batch in sub-batches, the energy file is committed once all are done"""
+    construct_keys, window_sextuplets = center_constructs
+    energy_file = uf.create_energy_file(energy_file_path)
+    
+    for i in range(0, len(construct_keys), cf.ENERGY_BATCH_MAXIMAL_CONSTRUCTS):
+        results = next(centers_energies([window_sextuplets[i : i + cf.ENERGY_BATCH_MAXIMAL_CONSTRUCTS]], energy_cache, executor, pool_size))
+        dump_constructs_energies(energy_file, center_ID, construct_keys[i : i + cf.ENERGY_BATCH_MAXIMAL_CONSTRUCTS], results)
+    
+    uf.commit_buffered_file(energy_file)
+    cm.record_completed_center(manifest, process_number, center_ID)
+    return_connection.send((process_number, center_ID))
+
+
+def energies_from_sequence_constructs(process_number, instructions, task_queue, return_connection):
     """Calculates energies from given relative sequence constructs"""
     process_done = False
-    while True:
-            
-        new_centers_to_treat, process_done = get_new_centers(task_queue)
-        for center_ID in new_centers_to_treat:
-            
-            # Preparing sequence associated variables
-            sequence_ID = uf.sequence_ID_from_ID(center_ID)
-            sequence_energies_folder_path = f"{uv.ENERGY_FOLDER}{sequence_ID}{os.sep}"
-            if not os.path.isdir(sequence_energies_folder_path):
-                os.mkdir(sequence_energies_folder_path) 
-            energy_file_path = f"{sequence_energies_folder_path}{center_ID}-EF.csv"
+    reference_sequence = []
+    streamed_constructs = {}
+    energy_cache = None
+    if cf.DUPLEX_ENERGY_CACHE:
+        energy_cache = dec.open_energy_cache()
+    manifest = cm.open_manifest()
+
+    # Note: The pool lives as long as the process, workers are fed with chunks of constructs gathered across centers
+    pool_size = energy_pool_size(process_number)
+    
+    # Replicas take one center at a time so that the centers are spread over all of them
+    maximal_centers = None if cf.PROCESS_REPLICAS.get(process_number, 1) == 1 else 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=pool_size) as executor:
+        while True:
                 
-            # Verifying that energies are not already calculated, if there are we can pass the center to the next processes
-            if os.path.isfile(energy_file_path):
-                return_queue.put((process_number, center_ID))
-                continue
-            
-            # Preparing energy file
-            uf.create_energy_file(energy_file_path)
-            
-            # Gathering constructs information
-            constructs = {}
-            with open(f"{uv.CONSTRUCT_FOLDER}{sequence_ID}{os.sep}{center_ID}-CF.csv", "r") as file:
-                reader = csv.reader(file)
-                for i, row in enumerate(reader):
-                    if i == 0:
-                        continue
-                    constructs[row[0]] = (row[6], row[7], row[8], row[9], row[10], row[11])
-            
-            # Launching parallel computation of all constructs for one center
-            results = constructs_parallel_thread(constructs)
-            
-            # Outputing results to energy file
-            for construct_ID, energies in results.items():
-                uf.dump_energy_file_line(
-                    energy_file_path, 
-                    [
-                        construct_ID, energies[0], energies[1], energies[2]
-                    ]
-                )
+            new_centers_to_treat, process_done = get_new_centers(task_queue, maximal_centers, streamed_constructs)
+            center_batch = {}
+            center_batch_size = 0
+            for center_ID in new_centers_to_treat:
+                
+                # Preparing sequence associated variables
+                sequence_ID = uf.sequence_ID_from_ID(center_ID)
+                sequence_energies_folder_path = f"{uv.ENERGY_FOLDER}{sequence_ID}{os.sep}"
+                if not os.path.isdir(sequence_energies_folder_path):
+                    os.mkdir(sequence_energies_folder_path) 
+                energy_file_path = f"{sequence_energies_folder_path}{center_ID}-EF.csv"
+                    
+                # Verifying that energies are not already calculated, if there are we can pass the center to the next processes
+                if cm.center_completed(manifest, process_number, center_ID, energy_file_path):
+                    streamed_constructs.pop(center_ID, None)
+                    return_connection.send((process_number, center_ID))
+                    continue
+                
+                center_constructs = load_center_constructs(sequence_ID, center_ID, instructions, reference_sequence, streamed_constructs)
+                
+                # Centers bigger than a batch are split into sub-batches, so that a single center does not exceed the memory of a batch
+                if len(center_constructs[0]) > cf.ENERGY_BATCH_MAXIMAL_CONSTRUCTS:
+                    energies_from_large_center(process_number, center_ID, energy_file_path, center_constructs, energy_cache, executor, pool_size, manifest, return_connection)
+                    continue
+                
+                center_batch[center_ID] = (energy_file_path, center_constructs)
+                center_batch_size += len(center_constructs[0])
+
+                # Bounding the memory used by a batch
+                if center_batch_size >= cf.ENERGY_BATCH_MAXIMAL_CONSTRUCTS:
+                    energies_from_center_batch(process_number, center_batch, energy_cache, executor, pool_size, manifest, return_connection)
+                    center_batch = {}
+                    center_batch_size = 0
+
+            if len(center_batch) > 0:
+                energies_from_center_batch(process_number, center_batch, energy_cache, executor, pool_size, manifest, return_connection)
                 
-            return_queue.put((process_number, center_ID))
-            
-        if process_done:
-            return_queue.put((process_number, uv.DONE))
-            break 
-    
\ No newline at end of file
+            if process_done:
+                # Reporting how much of the work was already paid for in previous executions
+                if energy_cache is not None:
+                    logger.info(f"Duplex energy cache, process {process_number}, hit rate: {dec.hit_rate(energy_cache):.3f} ({energy_cache[1]})")
+                    dec.close_energy_cache(energy_cache)
+                cm.close_manifest(manifest)
+                return_connection.send((process_number, uv.DONE))
+                break
@@ -1,13 +1,58 @@
 import sys
-import csv
 import traceback
 import os
+import logging
+import collections
+
+import numpy as np
+
 import UtilitiesFunction as uf
 import UtilitiesVariables as uv
+import Configuration as cf
+import DuplexEnergyCache as dec
+import CompletionManifest as cm
+
+logger = logging.getLogger(__name__)
 
 PROCESS_NUMBER = 6
 
-def score_centers(new_centers_to_treat):
+def load_reference_center_energies(reference_energy_file_path, reference_energy_cache):
+    """Gets the energies of a reference center, from the cache or from its energy file"""
+    cached_centers, cache_statistics = reference_energy_cache
+    if reference_energy_file_path in cached_centers:
+        cached_centers.move_to_end(reference_energy_file_path)
+        cache_statistics[uv.CACHE_HITS_KEY] += 1
+        return cached_centers[reference_energy_file_path][:3]
+    cache_statistics[uv.CACHE_MISSES_KEY] += 1
+
+    # Constructs are held as integer keys, the order of the keys permits finding constructs by binary search
+    construct_IDs, reference_energies = uf.load_energy_file(reference_energy_file_path)
+    construct_keys = uf.construct_keys_from_IDs(construct_IDs)
+    construct_key_order = np.argsort(construct_keys, kind="stable")
+    
+    center_size = reference_energies.nbytes + construct_keys.nbytes + construct_key_order.nbytes
+    cached_centers[reference_energy_file_path] = (construct_keys, construct_key_order, reference_energies, center_size)
+    cache_statistics[uv.CACHE_SIZE_KEY] += center_size
+
+    # Evicting least recently used centers, the center that was just loaded is always kept
+    while cache_statistics[uv.CACHE_SIZE_KEY] > cf.REFERENCE_ENERGY_CACHE_MAXIMAL_BYTES and len(cached_centers) > 1:
+        _, evicted_center = cached_centers.popitem(last=False)
+        cache_statistics[uv.CACHE_SIZE_KEY] -= evicted_center[3]
+
+    return construct_keys, construct_key_order, reference_energies
+
+
+def find_reference_constructs(construct_keys, construct_key_order, relative_construct_keys):
+    """Indexes of relative constructs in the reference constructs of their center"""
+    positions = np.searchsorted(construct_keys, relative_construct_keys, sorter=construct_key_order)
+    reference_indexes = construct_key_order[np.minimum(positions, len(construct_key_order) - 1)]
+    if not np.array_equal(construct_keys[reference_indexes], relative_construct_keys):
+        raise Exception("Error, In: Sequence fragility scorer, relative constructs are missing from the reference constructs of their center")
+    
+    return reference_indexes
+
+
+def score_centers(new_centers_to_treat, reference_energy_cache, manifest):
     """Extracts new centers to treat from task queue"""
     for ID_parts in new_centers_to_treat:
         
@@ -32,39 +77,37 @@ def score_centers(new_centers_to_treat):
         if not os.path.isdir(fragility_folder_path):
             os.mkdir(fragility_folder_path)
         
-        if os.path.isfile(fragility_file_path):
+        if cm.center_completed(manifest, PROCESS_NUMBER, relative_center_ID, fragility_file_path):
             continue
 
-        # Gathering energies information for the reference
-        scores = {}
-        energies = {}
-
-        with open(reference_energy_file_path, "r") as file:
-            reader = csv.reader(file)
-            for i, row in enumerate(reader):
-                if i == 0:
-                    continue
-                construct_name = uf.contruct_name_from_ID(row[0])
-                energies[construct_name] = [float(row[1]), float(row[2]), float(row[3])]
-                scores[construct_name] = uf.generate_base_score()
-
-        # Gathering energies information for the reference and scoring
-        with open(relative_energy_file_path, "r") as file:
-            reader = csv.reader(file)
-            for i, row in enumerate(reader):
-                if i == 0:
-                    continue
-                construct_name = uf.contruct_name_from_ID(row[0])
-                scores[construct_name][0] = uf.score_fragility(energies[construct_name][0], float(row[1]))
-                scores[construct_name][1] = uf.score_fragility(energies[construct_name][1], float(row[2]))
-                scores[construct_name][2] = uf.score_fragility(energies[construct_name][2], float(row[3]))
-                scores[construct_name][3] = True
-
-        uf.create_fragility_file(fragility_file_path)
-
-        for construct_name, row in scores.items():
-            construct_id = f"{relative_sequence_ID}-{construct_name}"
-            uf.dump_fragility_file_line(fragility_file_path, [construct_id, row[0], row[1], row[2], row[3]])
+        # Gathering energies information for the reference, the reference of a center is shared by all individuals
+        construct_keys, construct_key_order, reference_energies = load_reference_center_energies(reference_energy_file_path, reference_energy_cache)
+
+        # Gathering energies information for the relative and scoring all constructs at once
+        relative_construct_IDs, relative_energies = uf.load_energy_file(relative_energy_file_path)
+        scored_indexes = find_reference_constructs(construct_keys, construct_key_order, uf.construct_keys_from_IDs(relative_construct_IDs))
+        
+        relative_scores = uf.score_fragility_array(reference_energies[scored_indexes], relative_energies).tolist()
+
+        # Sparse fragility files only hold the constructs containing variants, the others implicitly have the base score
+        if cf.SPARSE_FRAGILITY_FILES:
+            fragility_file = uf.create_sparse_fragility_file(fragility_file_path)
+            arm_3_starts, arm_4_starts = uf.arm_starts_from_construct_key(construct_keys[scored_indexes])
+            for arm_3_start, arm_4_start, row in zip(arm_3_starts.tolist(), arm_4_starts.tolist(), relative_scores):
+                construct_id = f"{relative_sequence_ID}-{uf.form_construct_name(arm_3_start, arm_4_start)}"
+                uf.dump_fragility_file_line(fragility_file, [construct_id, row[0], row[1], row[2]])
+        else:
+            scores = [uf.generate_base_score() for _ in range(len(construct_keys))]
+            for construct_index, relative_score in zip(scored_indexes.tolist(), relative_scores):
+                scores[construct_index] = relative_score + [True]
+
+            fragility_file = uf.create_fragility_file(fragility_file_path)
+            arm_3_starts, arm_4_starts = uf.arm_starts_from_construct_key(construct_keys)
+            for arm_3_start, arm_4_start, row in zip(arm_3_starts.tolist(), arm_4_starts.tolist(), scores):
+                construct_id = f"{relative_sequence_ID}-{uf.form_construct_name(arm_3_start, arm_4_start)}"
+                uf.dump_fragility_file_line(fragility_file, [construct_id, row[0], row[1], row[2], row[3]])
+        uf.commit_buffered_file(fragility_file)
+        cm.record_completed_center(manifest, PROCESS_NUMBER, relative_center_ID)
 
 
 def get_new_centers_to_treat(task_queue, available_reference_energies, relative_energies_to_score, scorable_constructs, proceses_done):
@@ -92,50 +135,53 @@ def get_new_centers_to_treat(task_queue, available_reference_energies, relative_
         # Note :If the task is from process 2 then the task is the name of a reference center that corresponds to a reference energy file
         # If the task is from process 5 then the task is the name of a reference center that corresponds to a relative energy file
 
+        # Note: Centers are joined on (sequence, CGS, center), each side waits in a dictionary until the other side arrives
+        center_key = (first_ID_part, second_ID_part)
+
         if new_task[0] == 2:
-            available_reference_energies.append((first_ID_part, second_ID_part))
+            available_reference_energies.add(center_key)
 
-            # Adding to scorable constructs all construct where the reference and relative energies have been calculated 
-            for individual, ID_parts_individual in relative_energies_to_score.items():
-                for ID_parts in ID_parts_individual:
-                    if ID_parts[0] == first_ID_part and ID_parts[1] == second_ID_part:
-                        scorable_constructs.append((individual, ID_parts[0], ID_parts[1]))
+            # Adding to scorable constructs all individuals whose relative energies were waiting for this reference center
+            for individual in relative_energies_to_score.pop(center_key, []):
+                scorable_constructs.append((individual, first_ID_part, second_ID_part))
                 
         elif new_task[0] == 5:
             individual = uf.individual_name_from_ID(new_task[1])
 
-            relative_energies_to_score[individual].append((first_ID_part, second_ID_part))
-
-            # Adding to scorable constructs all construct where the reference and relative energies have been calculated 
-            for ID_parts in available_reference_energies:
-                if ID_parts[0] == first_ID_part and ID_parts[1] == second_ID_part:
-                    scorable_constructs.append((individual, ID_parts[0], ID_parts[1]))
+            # Adding to scorable constructs the construct if the reference energies have already been calculated
+            if center_key in available_reference_energies:
+                scorable_constructs.append((individual, first_ID_part, second_ID_part))
+            else:
+                relative_energies_to_score.setdefault(center_key, []).append(individual)
 
 
-def score_relative_sequences(instructions, task_queue, return_queue):
+def score_relative_sequences(instructions, task_queue, return_connection):
     """Generates scores from given sequences"""
 
     # Preapring generation level variables
     proceses_done = [False, False]
-    available_reference_energies = []
-    individuals = instructions[uv.INDIVIDUALS_KEY]
-    relative_energies_to_score = dict.fromkeys(individuals, [])
+    available_reference_energies = set()
+    relative_energies_to_score = {}
+    manifest = cm.open_manifest()
+    reference_energy_cache = (collections.OrderedDict(), {uv.CACHE_HITS_KEY: 0, uv.CACHE_MISSES_KEY: 0, uv.CACHE_SIZE_KEY: 0})
     
     while True:
 
         scorable_constructs = []
         get_new_centers_to_treat(task_queue, available_reference_energies, relative_energies_to_score, scorable_constructs, proceses_done)
-        score_centers(scorable_constructs)
+        score_centers(scorable_constructs, reference_energy_cache, manifest)
 
         if proceses_done[0] and proceses_done[1]:
-            return_queue.put((PROCESS_NUMBER, uv.DONE))
+            cm.close_manifest(manifest)
+            logger.info(f"Reference energy cache, process {PROCESS_NUMBER}, hit rate: {dec.hit_rate(reference_energy_cache):.3f} ({reference_energy_cache[1]})")
+            return_connection.send((PROCESS_NUMBER, uv.DONE))
             break       
 
 
-def run_process(instructions, task_queue, return_queue, error_queue):
+def run_process(instructions, task_queue, return_connection, error_queue):
     """Permits running process from controller and handling error catching"""
     try:
-       score_relative_sequences(instructions, task_queue, return_queue)
+       score_relative_sequences(instructions, task_queue, return_connection)
     except Exception as error:
         excecution_information = sys.exc_info()
         formatted_exception =  traceback.format_exception( *excecution_information)
@@ -1,8 +1,16 @@
 import os
+import copy
 import json
+import time
 import csv
+import gzip
+import bisect
+
+import numpy as np
 
 import UtilitiesVariables as uv
+import Configuration as cf
+import ResultStore as rs
 
 ### Hardcoded paths
 def instructions_path(execution_ID):
@@ -10,6 +18,11 @@ def instructions_path(execution_ID):
     return(f"{uv.EXECUTION_FOLDER}{execution_ID}{os.sep}{execution_ID}-instructions.json")
 
 
+def process_log_path(execution_ID):
+    """Standard function to generate path to the process logs, without extension"""
+    return f"{uv.EXECUTION_FOLDER}{execution_ID}{os.sep}{execution_ID}-process_log"
+
+
 ### Standardised file creation
 def create_instructions(execution_ID, settings):
     """Standard function for creating instruction file"""
@@ -18,9 +31,68 @@ def create_instructions(execution_ID, settings):
 
 
 def create_json_log(json_log_path):
-    """Function that creates the empty json log"""
-    with open(json_log_path, "w") as file:
-        json.dump(uv.PROCESS_LOG, file)
+    """Function that creates the empty json lines event log"""
+    with open(json_log_path, "w"):
+        pass
+
+
+def open_buffered_file(file_path, first_line):
+    """Standard function for opening a buffered output file, rows are written to a temporary file until the file is committed"""
+    # Note: With the result store, rows are kept in memory and stored in one transaction when the file is committed
+    if cf.RESULT_STORE:
+        return file_path, None, [first_line]
+    temporary_file_path = f"{file_path}{uv.TEMPORARY_FILE_SUFFIX}"
+    file = open(temporary_file_path, "w", newline='', buffering=cf.FILE_WRITE_BUFFER_SIZE)
+    writer = csv.writer(file)
+    writer.writerow(first_line)
+    return file_path, file, writer
+
+
+def commit_buffered_file(buffered_file):
+    """Standard function for closing a buffered output file and atomically moving it to its final path"""
+    file_path, file, writer = buffered_file
+    if cf.RESULT_STORE:
+        rs.store_center_rows(result_store_center_key(file_path), writer[0], writer[1:])
+        return
+    file.flush()
+    os.fsync(file.fileno())
+    file.close()
+    # Note: Once the file exists under its final name it is complete, partial files keep the temporary suffix
+    os.replace(f"{file_path}{uv.TEMPORARY_FILE_SUFFIX}", file_path)
+
+
+def write_buffered_rows(buffered_file, rows):
+    """Standard function for adding rows to a buffered output file"""
+    if cf.RESULT_STORE:
+        buffered_file[2].extend(rows)
+    else:
+        buffered_file[2].writerows(rows)
+
+
+def result_store_center_key(file_path):
+    """Key of a center output file in the result store: kind (file suffix), center ID, sequence ID, CGS ID and center"""
+    file_name = os.path.basename(file_path)
+    kind = file_name[-len("-CF.csv"):]
+    center_ID = file_name[:-len(kind)]
+    return kind, center_ID, sequence_ID_from_ID(center_ID), construct_generation_specification_from_ID(center_ID), int(center_ID.split('-')[-1])
+
+
+def output_file_exists(file_path):
+    """Check if a center output file was committed, in the result store or as a file"""
+    if cf.RESULT_STORE:
+        return rs.center_stored(result_store_center_key(file_path))
+    return os.path.isfile(file_path)
+
+
+def read_output_file(file_path):
+    """Reading the first line and the rows of a center output file, from the result store or from the file"""
+    if cf.RESULT_STORE:
+        return rs.load_center_rows(result_store_center_key(file_path))
+    with open(file_path, "r") as file:
+        reader = csv.reader(file)
+        first_line = next(reader)
+        rows = list(reader)
+    return first_line, rows
 
 
 def create_construct_file(construct_file_path):
@@ -29,8 +101,12 @@ def create_construct_file(construct_file_path):
         ["ConstructID", "CenterPosition", "Arm1Start", "Arm2Start", " Arm3Start", "Arm4Start", "SequenceWindow1",
         "SequenceWindow2", "SequenceWindow3", "SequenceWindow4", "SequenceWindow5", "SequenceWindow6"]
     )
-    with open(construct_file_path, "a", newline='') as file:
-        csv.writer(file).writerow(first_line)
+    return open_buffered_file(construct_file_path, first_line)
+
+
+def create_virtual_construct_file(construct_file_path):
+    """Function that creates the empty virtual construct file, that only holds arm starts relative to the subsequence"""
+    return open_buffered_file(construct_file_path, uv.VIRTUAL_CONSTRUCT_FILE_FIRST_LINE)
 
 
 def create_energy_file(energy_file_path):
@@ -38,8 +114,7 @@ def create_energy_file(energy_file_path):
     first_line = (
         ["ConstructID", "EnergyLeft", "EnergyRight", "Energy"]
     )
-    with open(energy_file_path, "a", newline='') as file:
-        csv.writer(file).writerow(first_line)
+    return open_buffered_file(energy_file_path, first_line)
 
 
 def create_fragility_file(fragility_file_path):
@@ -47,38 +122,60 @@ def create_fragility_file(fragility_file_path):
     first_line = (
         ["ConstructID", "ScoreLeft", "ScoreRight", "DifferenceEnergy","ContainsVariant"]
     )
-    with open(fragility_file_path, "a", newline='') as file:
-        csv.writer(file).writerow(first_line)
+    return open_buffered_file(fragility_file_path, first_line)
+
+
+def create_sparse_fragility_file(fragility_file_path):
+    """Function that creates the empty sparse fragility file, that only holds the constructs containing variants"""
+    return open_buffered_file(fragility_file_path, uv.SPARSE_FRAGILITY_FILE_FIRST_LINE)
 
 
 ### Standardised file dumping
 def dump_log(log_file_path, category, key, value):
-    """Standard function for adding entries to the json log"""
-    with open(log_file_path, "r") as file:
-        log = json.load(file)
+    """Standard function for adding entries to the json lines event log"""
+    # Note: Events are only appended, the log is never read back during the execution
+    event = {uv.EVENT_TIME_KEY: time.time(), uv.EVENT_CATEGORY_KEY: category, uv.EVENT_KEY_KEY: key, uv.EVENT_VALUE_KEY: value}
+    with open(log_file_path, "a") as file:
+        file.write(json.dumps(event) + "\n")
+
+
+def compact_log(execution_ID):
+    """Replays the json lines event log of an execution into the process log (json), the last event of a key wins"""
+    log_file_paths = process_log_path(execution_ID)
+    log = copy.deepcopy(uv.PROCESS_LOG)
+    with open(log_file_paths + ".jsonl", "r") as file:
+        for line in file:
+            # A line cut by an interrupted execution is ignored
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            log.setdefault(event[uv.EVENT_CATEGORY_KEY], {})[str(event[uv.EVENT_KEY_KEY])] = event[uv.EVENT_VALUE_KEY]
     
-    log[category][key] = value
-
-    with open(log_file_path, "w") as file:
-        json.dump(log, file) 
+    with open(log_file_paths + ".json", "w") as file:
+        json.dump(log, file)
+    
+    return log
 
 
-def dump_construct_file_line(construct_file_path, line):
+def dump_construct_file_line(construct_file, line):
     """Standard function for adding entries to the construct file"""
-    with open(construct_file_path, "a", newline='') as file:
-        csv.writer(file).writerow(line)
+    write_buffered_rows(construct_file, [line])
+
 
+def dump_construct_file_lines(construct_file, lines):
+    """Standard function for adding a block of entries to the construct file"""
+    write_buffered_rows(construct_file, lines)
 
-def dump_energy_file_line(energy_file_path, line):
+
+def dump_energy_file_line(energy_file, line):
     """Standard function for adding entries to the energy file"""
-    with open(energy_file_path, "a", newline='') as file:
-        csv.writer(file).writerow(line)
+    write_buffered_rows(energy_file, [line])
 
 
-def dump_fragility_file_line(fragility_file_path, line):
+def dump_fragility_file_line(fragility_file, line):
     """Standard function for adding entries to the fragility file"""
-    with open(fragility_file_path, "a", newline='') as file:
-        csv.writer(file).writerow(line)
+    write_buffered_rows(fragility_file, [line])
 
 
 def dump_relative_sequence(individual_ID, relative_sequence):
@@ -90,16 +187,69 @@ def dump_relative_sequence(individual_ID, relative_sequence):
 
 
 ### Standardised file loading
+def open_text_file(file_path):
+    """Standard function for opening an input text file for reading, gzip compressed files (.gz) are decompressed on the fly"""
+    if file_path.endswith(".gz"):
+        return gzip.open(file_path, "rt")
+    return open(file_path, "r")
+
+
 def load_fasta(file_path):
     """Standard function for loading onse sequence fasta file"""
-    with open(file_path, "r") as fasta_file:
-        lines = fasta_file.readlines()
-    
-    sequence =  ''.join(lines[1:]).replace("\n", "")
+    with open_text_file(file_path) as fasta_file:
+        next(fasta_file)
+        sequence = ''.join(line.rstrip("\n") for line in fasta_file)
     
     return sequence
 
 
+def load_construct_file(construct_file_path):
+    """Standard function for loading a construct file, indicates if the file is a virtual construct file"""
+    first_line, rows = read_output_file(construct_file_path)
+    
+    return first_line == uv.VIRTUAL_CONSTRUCT_FILE_FIRST_LINE, rows
+
+
+def load_energy_file(energy_file_path):
+    """Standard function for loading an energy file, returns the construct IDs and an array of their left, right and total energies"""
+    construct_IDs = []
+    energies = []
+    _, rows = read_output_file(energy_file_path)
+    for row in rows:
+        construct_IDs.append(row[0])
+        energies.append((float(row[1]), float(row[2]), float(row[3])))
+    
+    return construct_IDs, np.array(energies, dtype=np.float64).reshape(-1, 3)
+
+
+def load_fragility_file(fragility_file_path, full_view=False):
+    """Standard function for loading a fragility file, sparse fragility files can be expanded to the full view with all reference constructs"""
+    first_line, rows = read_output_file(fragility_file_path)
+    
+    if first_line != uv.SPARSE_FRAGILITY_FILE_FIRST_LINE:
+        return rows
+    if not full_view:
+        return [row + [str(True)] for row in rows]
+    
+    # Constructs missing from a sparse file are the reference constructs without variants, their scores are the base score
+    relative_center_ID = os.path.basename(fragility_file_path)[:-len("-FF.csv")]
+    relative_sequence_ID = sequence_ID_from_ID(relative_center_ID)
+    reference_sequence_ID = reference_sequence_ID_from_ID(relative_center_ID, False)
+    reference_center_ID = f"{reference_sequence_ID}{relative_center_ID[len(relative_sequence_ID):]}"
+    reference_construct_IDs, _ = load_energy_file(f"{uv.ENERGY_FOLDER}{reference_sequence_ID}{os.sep}{reference_center_ID}-EF.csv")
+    
+    scored_rows = {contruct_name_from_ID(row[0]): row for row in rows}
+    full_rows = []
+    for reference_construct_ID in reference_construct_IDs:
+        construct_name = contruct_name_from_ID(reference_construct_ID)
+        if construct_name in scored_rows:
+            full_rows.append(scored_rows[construct_name] + [str(True)])
+        else:
+            full_rows.append([f"{relative_sequence_ID}-{construct_name}"] + [str(score) for score in generate_base_score()])
+    
+    return full_rows
+
+
 def load_instructions_base(execution_ID):
     """Standard function for loading instruction file"""
     with open(instructions_path(execution_ID), "r") as file:
@@ -159,6 +309,21 @@ def load_relative_sequence(relative_sequence_path, sequence_coordinates):
     return relative_sequence
 
 
+### Variant index
+def build_variant_index(relative_sequence):
+    """Sorting variants by position so that the variants inside of a range can be found by bisection"""
+    # Note: The sort is stable, variants at the same position (successive insertions) keep their order
+    variants = sorted(relative_sequence, key=lambda variant: variant[0])
+    positions = [variant[0] for variant in variants]
+    return positions, variants
+
+
+def variants_in_range(variant_index, start, end):
+    """Get the variants with a position in [start, end) from a variant index"""
+    positions, variants = variant_index
+    return variants[bisect.bisect_left(positions, start) : bisect.bisect_left(positions, end)]
+
+
 ### Instructions preparation
 def add_individuals_to_settings(settings):
     """From settings and group file get individuals to launch and add them to the settings"""
@@ -167,7 +332,35 @@ def add_individuals_to_settings(settings):
     settings[uv.INDIVIDUALS_KEY]  = groups[settings[uv.INDIVIDUALS_GROUP_KEY]]
 
 
+def register_individuals(file_name, sample_names, reference_sequence_name, group_name):
+    """Adds the samples of a cohort file to the individuals information and to a group of the group file"""
+    with open(uv.INDIVIDUALS_INFORMATION_PATH, "r") as file:
+        individuals_information = json.load(file)
+    with open(uv.INDIVIDUALS_GROUPS_PATH, "r") as file:
+        groups = json.load(file)
+
+    # Information of a cohort individual also holds its sample name, as it is in the cohort file
+    individuals = []
+    for sample_name in sample_names:
+        individual_ID = form_individual_ID(sample_name)
+        individuals_information[individual_ID] = [reference_sequence_name, file_name, sample_name]
+        individuals.append(individual_ID)
+    groups[group_name] = individuals
+
+    with open(uv.INDIVIDUALS_INFORMATION_PATH, "w") as file:
+        json.dump(individuals_information, file, indent=2)
+    with open(uv.INDIVIDUALS_GROUPS_PATH, "w") as file:
+        json.dump(groups, file, indent=4)
+
+    return individuals
+
+
 ### Forming IDs
+def form_individual_ID(sample_name):
+    """Forms the individual ID of a sample of a cohort file, dashes are reserved as ID separators"""
+    return sample_name.replace("-", "_")
+
+
 def form_reference_sequence_ID(reference_sequence_name, subsequence_name):
     """Forms the standard reference sequence ID from the given instructions"""
     # Template SEQ-[Official_Name]-[SubSequence_Name]
@@ -200,7 +393,31 @@ def form_center_ID(sequence_ID, construct_generation_specification_ID, center):
 def form_construct_ID(center_ID, arm_3_start, arm_4_start):
     """Forms the standard construct ID from the given instructions"""
     # Template CenterID-CON-[arm_3_start]-[arm_4_start]
-    return f"{center_ID}-{uv.CONSTRUCT_ID_SEPARATOR}-{arm_3_start}-{arm_4_start}"
+    return f"{center_ID}-{form_construct_name(arm_3_start, arm_4_start)}"
+
+
+def form_construct_name(arm_3_start, arm_4_start):
+    """Forms the construct name, the part of the construct ID identifying the construct inside of its center"""
+    # Template CON-[arm_3_start]-[arm_4_start]
+    return f"{uv.CONSTRUCT_ID_SEPARATOR}-{arm_3_start}-{arm_4_start}"
+
+
+### Compact construct keys
+def form_construct_key(arm_3_start, arm_4_start):
+    """Forms the integer key of a construct inside of its center, works on single starts and on arrays of starts"""
+    # Note: Arm 3 start is held by the high 32 bits and arm 4 start by the low 32 bits, keys are ordered like the constructs of a center
+    return (arm_3_start << uv.CONSTRUCT_KEY_SHIFT) | arm_4_start
+
+
+def arm_starts_from_construct_key(construct_key):
+    """Takes a construct key (or an array of construct keys) and finds arm 3 and arm 4 starts"""
+    return construct_key >> uv.CONSTRUCT_KEY_SHIFT, construct_key & uv.CONSTRUCT_KEY_MASK
+
+
+def construct_keys_from_IDs(construct_IDs):
+    """Takes construct IDs and finds their construct keys as an array, human readable IDs are only parsed when they are loaded"""
+    arm_starts = np.array([construct_ID.rsplit("-", 2)[1:] for construct_ID in construct_IDs], dtype=np.int64).reshape(-1, 2)
+    return form_construct_key(arm_starts[:, 0], arm_starts[:, 1])
 
 
 ### Gathering information from IDs
@@ -264,11 +481,25 @@ def get_reference_coordinates(bp, sequence_coordinates):
         
     return initial_coordinates
 
+def get_reference_coordinates_array(bps, sequence_coordinates):
+    """Translates an array of relative coordinates in the subsequence to coordinates inside the reference sequence"""
+    if len(sequence_coordinates) == 1:
+        initial_coordinates = bps + sequence_coordinates[0]
+    else:
+        initial_coordinates = np.where(bps < sequence_coordinates[0], bps + sequence_coordinates[1], bps - sequence_coordinates[0])
+        
+    return initial_coordinates
+
 ### Score fragility
 def score_fragility(reference_energy, relative_energy):
     """Standard fragility scoring"""
     return reference_energy - relative_energy
 
+
+def score_fragility_array(reference_energies, relative_energies):
+    """Standard fragility scoring of arrays of energies"""
+    return np.subtract(reference_energies, relative_energies)
+
 def generate_base_score():
     """Standard base score"""
     return [0, 0, 0, False]
\ No newline at end of file
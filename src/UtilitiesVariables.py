@@ -16,6 +16,27 @@ CONSTRUCT_GENSPECS_ID_SEPARATOR = "CGS"
 CENTER_ID_SEPARATOR = "CEN"
 CONSTRUCT_ID_SEPARATOR = "CON"
 
+## Construct keys
+CONSTRUCT_KEY_SHIFT = 32
+CONSTRUCT_KEY_MASK = (1 << CONSTRUCT_KEY_SHIFT) - 1
+
+## Output files
+TEMPORARY_FILE_SUFFIX = ".part"
+VIRTUAL_CONSTRUCT_FILE_FIRST_LINE = ["Arm3Start", "Arm4Start"]
+SPARSE_FRAGILITY_FILE_FIRST_LINE = ["ConstructID", "ScoreLeft", "ScoreRight", "DifferenceEnergy"]
+
+## Alignment modes
+GLOBAL_ALIGNMENT = "Global"
+ANCHORED_ALIGNMENT = "Anchored"
+
+## Vcf files
+VCF_CHROM_COLUMN = 0
+VCF_POS_COLUMN = 1
+VCF_REF_COLUMN = 3
+VCF_ALT_COLUMN = 4
+VCF_FIRST_SAMPLE_COLUMN = 9
+VCF_MITOCHONDRIAL_CONTIGS = ["chrM", "chrMT", "MT", "M"]
+
 ## Hardcoded Paths
 CONSTRUCT_FOLDER = f"..{os.sep}Constructs{os.sep}"
 ENERGY_FOLDER = f"..{os.sep}Energies{os.sep}"
@@ -25,6 +46,15 @@ EXECUTION_FOLDER = f"..{os.sep}Executions{os.sep}"
 INDIVIDUALS_FOLDER = f"..{os.sep}Individuals{os.sep}"
 SEQUENCE_FOLDER = f"..{os.sep}Sequences{os.sep}"
 
+DUPLEX_ENERGY_CACHE_PATH = f"{ENERGY_FOLDER}duplex_energy_cache.sqlite"
+COMPLETION_MANIFEST_PATH = f"{EXECUTION_FOLDER}completion_manifest.sqlite"
+REFERENCE_STORE_FOLDER = f"{SEQUENCE_FOLDER}Store{os.sep}"
+RESULT_STORE_PATH = f"..{os.sep}result_store.sqlite"
+# Center output file suffixes and their folders, the kinds of rows in the result store
+RESULT_STORE_KINDS = {"-CF.csv": CONSTRUCT_FOLDER, "-EF.csv": ENERGY_FOLDER, "-FF.csv": FRAGILITY_FOLDER}
+# Storage backends of center outputs, recorded in the completion manifest
+FILE_BACKEND = "File"
+RESULT_STORE_BACKEND = "ResultStore"
 REFERENCE_SEQUENCE_INFORMATION_PATH = f"{SEQUENCE_FOLDER}reference_sequence_information.json"
 INDIVIDUALS_GROUPS_PATH = f"{INDIVIDUALS_FOLDER}group_file.json"
 INDIVIDUALS_INFORMATION_PATH = f"{INDIVIDUALS_FOLDER}individuals_information.json"
@@ -47,6 +77,10 @@ ARM_SIZE_KEY = "ArmSize"
 ## Reference Sequence Information keys
 PATH = "Path"
 SUBSEQUENCES = "SubSequences"
+REFERENCE_STORE_SOURCE_KEY = "Source"
+REFERENCE_STORE_COORDINATES_KEY = "SequenceCoordinates"
+REFERENCE_STORE_FASTA_SIZE_KEY = "FastaSize"
+REFERENCE_STORE_FASTA_TIME_KEY = "FastaModificationTime"
 
 ## Steps
 PROCESSES = {
@@ -59,6 +93,9 @@ PROCESSES = {
     6: ("6 - Sequence Fragility Scoring", "SequenceFragilityScorer"),
  }
 
+# Processes whose tasks are independent from each other, they can run as several replicas sharing one task queue
+REPLICABLE_PROCESSES = [2, 5]
+
 PROCCES_ACTIVE_FOR_STEPS = {
     0: [1, 2 ,3],
     1: [1, 2, 3, 4, 5],
@@ -74,6 +111,12 @@ END_APP_KEY = "Ending Application"
 LOOP_KEY = "Loop Start"
 LOOP_YIELD_KEY = "Loop Yield"
 ERROR_KEY = "Error"
+PROCESS_COUNTERS_KEY = "Process Counters"
+
+EVENT_TIME_KEY = "Time"
+EVENT_CATEGORY_KEY = "Category"
+EVENT_KEY_KEY = "Key"
+EVENT_VALUE_KEY = "Value"
 
 PROCESS_LOG = {
    TIMEPOINTS_KEY: {
@@ -94,10 +137,17 @@ PROCESS_LOG = {
    },
    LOOP_KEY: {},
    LOOP_YIELD_KEY: {},
+   PROCESS_COUNTERS_KEY: {},
    ERROR_KEY : {}
 }
 
 
+## Duplex energy cache statistics
+CACHE_HITS_KEY = "Hits"
+CACHE_MISSES_KEY = "Misses"
+CACHE_SIZE_KEY = "Size"
+
+
 ## Queues reserved keywords
 TASK = "Task"
 RETURN = "Return"
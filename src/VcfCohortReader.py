@@ -0,0 +1,102 @@
+import sys
+
+import UtilitiesVariables as uv
+import UtilitiesFunction as uf
+
+def vcf_samples(vcf_file):
+    """Reads the header of an opened vcf file and returns the sample names, the file is left at the first record"""
+    for line in vcf_file:
+        if line.startswith("#CHROM"):
+            return line.rstrip("\n").split("\t")[uv.VCF_FIRST_SAMPLE_COLUMN:]
+    raise Exception("Error, Format not supported, In: Vcf cohort reading, no #CHROM header line found")
+
+
+def variants_from_vcf_alleles(position, reference_allele, alternative_allele):
+    """Translate a vcf allele into variants with the (position, op, base) format of relative sequences"""
+    # Note: Positions follow the alignment convention, a substitution or a deletion is on the base it affects
+    # and an insertion is on the reference base that follows it.
+
+    # Removing the bases shared at the start of both alleles (vcf indels always repeat the base before them)
+    shared_size = 0
+    while shared_size < min(len(reference_allele), len(alternative_allele)) and reference_allele[shared_size] == alternative_allele[shared_size]:
+        shared_size += 1
+    position += shared_size
+    reference_allele = reference_allele[shared_size:]
+    alternative_allele = alternative_allele[shared_size:]
+
+    variants = []
+    substituted_size = min(len(reference_allele), len(alternative_allele))
+    for i in range(substituted_size):
+        if reference_allele[i] != alternative_allele[i]:
+            variants.append([position + i, 'S', alternative_allele[i]])
+
+    # Remaining reference bases are deleted, remaining alternative bases are inserted
+    for i in range(substituted_size, len(reference_allele)):
+        variants.append([position + i, 'D'])
+    for base in alternative_allele[substituted_size:]:
+        variants.append([position + substituted_size, 'I', base])
+
+    return variants
+
+
+def genotype_allele(genotype):
+    """Allele carried by a sample, the first called alternative allele of its genotype (0 if none)"""
+    # Note: A relative sequence is a single haplotype, heteroplasmic calls (0/1) are considered as carrying the variant
+    for allele in genotype.replace("|", "/").split("/"):
+        if allele != "0" and allele != ".":
+            return int(allele)
+    return 0
+
+
+def relative_sequences_from_vcf(vcf_path, sample_names):
+    """Streams a multi-sample vcf file once and gathers the variants of the given samples"""
+    relative_sequences = {sample_name: [] for sample_name in sample_names}
+
+    with uf.open_text_file(vcf_path) as vcf_file:
+        samples = vcf_samples(vcf_file)
+        missing_samples = set(sample_names).difference(samples)
+        if len(missing_samples) > 0:
+            raise Exception(f"Error, In: Vcf cohort reading, samples {sorted(missing_samples)} are not in {vcf_path}")
+        sample_columns = [(uv.VCF_FIRST_SAMPLE_COLUMN + samples.index(sample_name), relative_sequences[sample_name]) for sample_name in sample_names]
+
+        for line in vcf_file:
+            fields = line.rstrip("\n").split("\t")
+            if fields[uv.VCF_CHROM_COLUMN] not in uv.VCF_MITOCHONDRIAL_CONTIGS:
+                continue
+
+            position = int(fields[uv.VCF_POS_COLUMN])
+            reference_allele = fields[uv.VCF_REF_COLUMN].upper()
+            alternative_alleles = fields[uv.VCF_ALT_COLUMN].upper().split(",")
+
+            # Variants of each alternative allele are computed once and shared by all samples carrying it
+            allele_variants = {}
+            for column, relative_sequence in sample_columns:
+                # Note: The genotype is always the first field of the sample column
+                allele = genotype_allele(fields[column].split(":", 1)[0])
+                if allele == 0:
+                    continue
+                if allele not in allele_variants:
+                    alternative_allele = alternative_alleles[allele - 1]
+                    # Symbolic and spanning deletion alleles do not describe bases and are ignored
+                    if alternative_allele.startswith("<") or alternative_allele == "*":
+                        allele_variants[allele] = []
+                    else:
+                        allele_variants[allele] = variants_from_vcf_alleles(position, reference_allele, alternative_allele)
+                relative_sequence.extend(allele_variants[allele])
+
+    return relative_sequences
+
+
+def register_vcf_cohort(vcf_file_name, reference_sequence_name, group_name):
+    """Adds every sample of a vcf file of the individuals folder to the individuals information and to a group of the group file"""
+    with uf.open_text_file(f"{uv.INDIVIDUALS_FOLDER}{vcf_file_name}") as vcf_file:
+        samples = vcf_samples(vcf_file)
+
+    return uf.register_individuals(vcf_file_name, samples, reference_sequence_name, group_name)
+
+
+if __name__ == "__main__":
+
+    # Usage: python VcfCohortReader.py [vcf file in the individuals folder] [reference sequence name] [group name]
+    individuals = register_vcf_cohort(sys.argv[1], sys.argv[2], sys.argv[3])
+    print(f"{len(individuals)} individuals added to group {sys.argv[3]}")